@@ -10,15 +10,26 @@
 import logging
 import datetime
 import time
+import uuid
+import json
 
 from stubo.cache.queue import String, Queue, get_redis_slave
 from stubo.cache.backends import RedisCacheBackend, get_redis_master
+from stubo.cache import local as local_cache
 from stubo.exceptions import exception_response
 from stubo.model.db import Scenario
 from stubo.model.stub import Stub, StubCache, response_hash
+from stubo.utils import has_template_markup, compute_hash
+from stubo.utils.stats import counters
+from stubo.utils.lru import LRUCache
 
 log = logging.getLogger(__name__)
 
+# cached requests this process marked as used recently, see touch_request
+recently_used = LRUCache(10000, 'request_cache.recently_used', ttl=10)
+# decoded stubs of playback session versions, see get_session_stubs
+session_stubs = LRUCache(100, 'session_stubs')
+
 """
 Redis is used for caching
 Keys are replicated from master to slave redis instances in distributed envs
@@ -37,6 +48,11 @@ host:sessions                   session_name->scenario_name
 name                            key->value (json)
 host:scenario_name              session_name -> session_data 
 
+Playback sessions carry a 'version' which changes each time the session
+cache is created, process local caches (compiled matchers) are keyed on it.
+The stubs of a playback session are not part of session_data, they are
+stored per version (see below) and added to the session by get_session.
+
 e.g.
 
 >>> print json.dumps(cache.get_session('first', 'first_1'), indent=4)
@@ -105,10 +121,38 @@ redis 127.0.0.1:6379> hgetall "localhost:first:request"
 2) "[[\"1a90f47bb0af291264a6c06868b97cd62b372d41de26c3fd21cef61b\"], \"\", \"2014-11-21\", \"2014-11-25\", {},
       \"84dab03cd9cbf56782635f95ef74efc641d993e768b79b4344452b45\"]"
 
+(Sorted Set)
+name                                                key->score
+host:scenario_name:request_lru:session_name:group   request_id->last used
+
+The request ids cached for the same response ids (group is their hash), the
+least recently used are evicted once there are more than request_cache_limit.
+
+(Hash)
+name                               key->value (raw)
+host:scenario_name:request_lrus    host:scenario_name:request_lru:session_name:group->session_name
+
+The request_lru sorted sets of the scenario, deleted with their sessions.
+
 (Hash)
 name                               key->value (raw)
 host:scenario_name:request_index   session_name:request_index_key->index
 
+(Hash)
+name                               key->value (compact json)
+host:scenario_name:stubs           session_name:version->[stub, ...]
+
+Each process decodes the stubs of a session version once, see
+get_session_stubs.
+
+(Pub/Sub channel)
+name                                     message (json)
+stubo:invalidate                         {scenario: scenario_key, session: session_name}
+                                         {delay_policy: host:delay_policy, names: [name, ...]}
+
+Published when sessions or delay policies change so each process drops its
+local copies of them, see stubo.cache.local.
+
 (Hash)
 name                                     key->value (json)
 host:scenario_name:saved_request_index   name-> {request_index_key : index}
@@ -163,8 +207,23 @@ class Cache(object):
         return '{0}:{1}'.format(self.host, scenario_name)
 
     def set_session(self, scenario_name, session_name, session_payload):
-        return self.set(self.scenario_key_name(scenario_name), session_name,
-                        session_payload)
+        scenario_key = self.scenario_key_name(scenario_name)
+        result = self.set(scenario_key, session_name, session_payload)
+        # the compiled session of this version, once compiled by
+        # create_session_cache, is not dropped when the message comes back
+        self.publish_invalidation(dict(scenario=scenario_key,
+                                       session=session_name,
+                                       version=session_payload.get('version')))
+        return result
+
+    def publish_invalidation(self, message):
+        """
+        Drops the local copies named by message in this process and publishes
+        it for the other processes, see stubo.cache.local.invalidate.
+        """
+        local_cache.invalidate(message)
+        self.get_cache_backend()(get_redis_master()).publish(
+            local_cache.channel, message)
 
     def set_session_map(self, scenario_name, session_name):
         return self.set_raw(self.get_sessions_map_key(), session_name,
@@ -228,6 +287,13 @@ class Cache(object):
             scenario_name))
         deleted_requests = self.get_cache_backend()(master).remove(self.get_request_key(
             scenario_name))
+        self.get_cache_backend()(master).remove(self.get_stubs_key(
+            scenario_name))
+
+        lrus_key = self.get_request_lrus_key(scenario_name)
+        for k in self.get_cache_backend()(master).keys(lrus_key):
+            self.get_cache_backend()(master).remove(k)
+        self.get_cache_backend()(master).remove(lrus_key)
 
         # delete request indexes
         deleted_request_indexes = []
@@ -243,6 +309,7 @@ class Cache(object):
             for k in session_names:
                 deleted_sessions_map += self.get_cache_backend()(master).delete(sessions_key, k)
         deleted_sessions = self.get_cache_backend()(master).remove(key)
+        self.publish_invalidation(dict(scenario=key, session=None))
         log.debug('deleted_response: {0}, deleted_requests: {1}, '
                   ', deleted_sessions_map: {2}, deleted_sessions: {3}, '
                   'deleted_request_indexes: {4}'.format(deleted_responses,
@@ -257,14 +324,25 @@ class Cache(object):
 
     def get_delay_policy(self, name, local=True):
         key = self.get_delay_policy_key()
-        if name:
-            return self.get_cache_backend()(get_redis_server(local)).get(key, name)
-        else:
+        if not name:
             return self.get_cache_backend()(get_redis_server(local)).get_all(key)
+        if not (local and local_cache.active()):
+            return self.get_cache_backend()(get_redis_server(local)).get(key, name)
+        delay_policy = local_cache.delay_policies.get((key, name))
+        if delay_policy is None:
+            read_generation = local_cache.generation()
+            delay_policy = self.get_cache_backend()(get_redis_server(local)).get(
+                key, name)
+            if delay_policy is not None:
+                local_cache.remember(local_cache.delay_policies, (key, name),
+                                     delay_policy, read_generation)
+        return delay_policy
 
     def set_delay_policy(self, name, data):
         key = self.get_delay_policy_key()
-        return self.get_cache_backend()(get_redis_master()).set(key, name, data)
+        result = self.get_cache_backend()(get_redis_master()).set(key, name, data)
+        self.publish_invalidation(dict(delay_policy=key, names=[name]))
+        return result
 
     def delete_delay_policy(self, names):
         num_deleted = 0
@@ -274,6 +352,7 @@ class Cache(object):
                 num_deleted += self.get_cache_backend()(get_redis_server(local=False)).delete(key, name)
         else:
             num_deleted = self.get_cache_backend()(get_redis_server(local=False)).remove(key)
+        self.publish_invalidation(dict(delay_policy=key, names=names or None))
         return num_deleted
 
     def key_name(self, scenario_name, key):
@@ -285,9 +364,21 @@ class Cache(object):
     def get_request_key(self, scenario_name):
         return self.key_name(scenario_name, "request")
 
+    def get_request_lru_key(self, scenario_name, session_name,
+                            response_ids):
+        group = compute_hash(u':'.join(unicode(x) for x in response_ids))
+        return self.key_name(scenario_name, "request_lru:{0}:{1}".format(
+            session_name, group))
+
+    def get_request_lrus_key(self, scenario_name):
+        return self.key_name(scenario_name, "request_lrus")
+
     def get_request_index_key(self, scenario_name):
         return self.key_name(scenario_name, "request_index")
 
+    def get_stubs_key(self, scenario_name):
+        return self.key_name(scenario_name, "stubs")
+
     def get_saved_request_index_key(self, scenario_name):
         return self.key_name(scenario_name, "saved_request_index")
 
@@ -326,7 +417,8 @@ class Cache(object):
         master = get_redis_master()
         keys = (self.get_request_key(scenario_name),
                 self.get_response_key(scenario_name),
-                self.get_request_index_key(scenario_name))
+                self.get_request_index_key(scenario_name),
+                self.get_stubs_key(scenario_name))
         hashes = [x.format(self.scenario_key_name(scenario_name)) for x in keys]
         for _hash in hashes:
             keys = self.get_cache_backend()(master).keys(_hash)
@@ -338,12 +430,19 @@ class Cache(object):
                 for k in session_keys:
                     num_deleted += self.get_cache_backend()(master).delete(_hash, k)
                 log.debug('deleted {0}'.format(num_deleted))
+        lrus_key = self.get_request_lrus_key(scenario_name)
+        lrus = self.get_cache_backend()(master).get_all_raw(lrus_key)
+        for k, lru_session in lrus.items():
+            if lru_session == session:
+                self.get_cache_backend()(master).remove(k)
+                self.get_cache_backend()(master).delete(lrus_key, k)
 
     def assert_valid_session(self, scenario_name, session_name):
         scenario_key = self.scenario_key_name(scenario_name)
         # if session exists it can only be dormant
         if self.exists(scenario_key, session_name):
-            session = self.get_session(scenario_name, session_name, local=False)
+            session = self.get_session(scenario_name, session_name,
+                                       local=False, stubs=False)
             session_status = session['status']
             if session_status != 'dormant':
                 raise exception_response(400, title='Session already exists '
@@ -383,29 +482,140 @@ class Cache(object):
         request_key = '{0}:{1}'.format(session_name, request_id)
         return self.get(self.get_request_key(scenario_name), request_key, local)
 
+    def lookup_request(self, scenario_name, session_name, request_id,
+                       normalised_request_id=None):
+        """
+        Look up cached requests by request id, then by normalised request id
+        if one is supplied. Returns the same as get_request.
+        """
+        found_id = request_id
+        cached_request = self.get_request(scenario_name, session_name,
+                                          request_id)
+        if not cached_request and normalised_request_id and \
+                normalised_request_id != request_id:
+            found_id = normalised_request_id
+            cached_request = self.get_request(scenario_name, session_name,
+                                              normalised_request_id)
+        self._request_looked_up(scenario_name, session_name, request_id,
+                                normalised_request_id,
+                                found_id if cached_request else None,
+                                cached_request)
+        return cached_request
+
+    def lookup_response(self, session_name, request_id,
+                        normalised_request_id=None, scenario_name=None):
+        """
+        Look up the scenario of the session unless scenario_name is supplied,
+        then the cached request as lookup_request does, its response and its
+        delay policy in a single round trip. Returns
+            scenario_name, cached_request, response, delay_policy
+        response is None if the stub has several responses, see get_response.
+        Raises 400 if the session is not found.
+        """
+        request_ids = [request_id]
+        if normalised_request_id and normalised_request_id != request_id:
+            request_ids.append(normalised_request_id)
+        scenario_name, found_id, cached_request, response, delay_policy = \
+            self.get_cache_backend()(get_redis_slave()).get_cached_response(
+                self.host, scenario_name, session_name, request_ids)
+        if not scenario_name:
+            raise exception_response(400, title='session not found - '
+                                     '{0}:{1}'.format(self.host, session_name))
+        self._request_looked_up(scenario_name, session_name, request_id,
+                                normalised_request_id, found_id,
+                                cached_request)
+        return scenario_name, cached_request, response, delay_policy
+
+    def _request_looked_up(self, scenario_name, session_name, request_id,
+                           normalised_request_id, found_id, cached_request):
+        counters.incr('request_cache.hit' if found_id == request_id else
+                      'request_cache.miss')
+        if found_id != request_id and normalised_request_id and \
+                normalised_request_id != request_id:
+            counters.incr('request_cache.normalised_hit' if found_id else
+                          'request_cache.normalised_miss')
+        if found_id:
+            self.touch_request(scenario_name, session_name, found_id,
+                               cached_request[0])
+
+    def touch_request(self, scenario_name, session_name, request_id,
+                      response_ids):
+        """
+        Mark a cached request as used so it is kept over less recently used
+        requests for the same response. Each process marks a request at most
+        once every recently_used.ttl seconds.
+        """
+        lru_key = self.get_request_lru_key(scenario_name, session_name,
+                                           response_ids)
+        if recently_used.get((lru_key, request_id)):
+            return
+        recently_used.set((lru_key, request_id), True)
+        # unless it was evicted since it was looked up
+        self.get_cache_backend()(get_redis_master()).touch(
+            lru_key, request_id,
+            hash_name=self.get_request_key(scenario_name),
+            hash_key='{0}:{1}'.format(session_name, request_id))
+
     def get_response(self, scenario_name, session_name, response_ids,
                      request_index_key):
         """
         returns response or None
         """
-        num_responses = len(response_ids)
-        index = 0
-        if num_responses > 1:
-            # stateful response: lookup the response index value stored on master
+        if len(response_ids) > 1:
+            # stateful response: the response index is stored on master, it is
+            # moved on and the response read there in one atomic call
             master = get_redis_master()
-            request_index_name = self.get_request_index_key(scenario_name)
-            request_index_key = '{0}:{1}'.format(session_name, request_index_key)
-            index = self.get(request_index_name, request_index_key)
-            if not index or index < num_responses:
-                index = self.get_cache_backend()(master).incr(request_index_name, request_index_key)
-            index -= 1
-        response_key = '{0}:{1}'.format(session_name, response_ids[index])
+            return self.get_cache_backend()(master).next_response(
+                self.get_request_index_key(scenario_name),
+                '{0}:{1}'.format(session_name, request_index_key),
+                self.get_response_key(scenario_name),
+                ['{0}:{1}'.format(session_name, x) for x in response_ids])
+        response_key = '{0}:{1}'.format(session_name, response_ids[0])
         return self.get(self.get_response_key(scenario_name), response_key,
                         local=True)
 
-    def get_session(self, scenario_name, session_name, local=True):
-        return self.get(self.scenario_key_name(scenario_name), session_name,
-                        local=local) or {}
+    def get_session(self, scenario_name, session_name, local=True,
+                    stubs=True):
+        """
+        Returns the session data, with the stubs of a playback session unless
+        stubs is False. Local reads with the stubs are kept by the process
+        while it is subscribed to invalidations, see stubo.cache.local.
+        """
+        scenario_key = self.scenario_key_name(scenario_name)
+        read_generation = None
+        if local and stubs and local_cache.active():
+            session = local_cache.sessions.get((scenario_key, session_name))
+            if session is not None:
+                return dict(session)
+            read_generation = local_cache.generation()
+        session = self.get(scenario_key, session_name, local=local) or {}
+        version = session.get('version')
+        if stubs and version and 'stubs' not in session:
+            session_stubs = self.get_session_stubs(scenario_name, session_name,
+                                                   version, local=local)
+            if session_stubs is not None:
+                session['stubs'] = session_stubs
+        if session and read_generation is not None:
+            local_cache.remember(local_cache.sessions,
+                                 (scenario_key, session_name), dict(session),
+                                 read_generation)
+        return session
+
+    def get_session_stubs(self, scenario_name, session_name, version,
+                          local=True):
+        """
+        Returns the stubs of a version of a playback session or None. They are
+        decoded once per process and shared, do not modify them.
+        """
+        key = (self.scenario_key_name(scenario_name), session_name, version)
+        stubs = session_stubs.get(key)
+        if stubs is None:
+            stubs = self.get(self.get_stubs_key(scenario_name),
+                             '{0}:{1}'.format(session_name, version),
+                             local=local)
+            if stubs is not None:
+                session_stubs.set(key, stubs)
+        return stubs
 
     def get_session_with_delay(self, scenario_name, session_name, retry_count=5,
                                retry_interval=1):
@@ -434,6 +644,7 @@ class Cache(object):
         log.debug("create_session_cache: scenario_key={0}, session_name={1}".format(
             scenario_key, session_name))
         session = self.get(scenario_key, session_name)
+        previous_version = session and session.get('version')
         if not session:
             # must be using a different session name for playback than record
             session = {
@@ -447,6 +658,8 @@ class Cache(object):
         session['system_date'] = system_date or datetime.date.today().strftime(
             '%Y-%m-%d')
         session['last_used'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        # identifies this playback of the session for process local caches
+        session['version'] = uuid.uuid4().hex
         cache_info = []
 
         # copy mongo scenario stubs to redis cache
@@ -477,6 +690,10 @@ class Cache(object):
             # cache each response id -> response (text, status) etc
             for response_text in response_bodys:
                 stub.set_response_body(response_text)
+                # get/response only runs templated responses thru a transform
+                stub.set_response_templated(
+                    not isinstance(response_text, basestring) or
+                    has_template_markup(response_text))
                 response_id = response_hash(response_text, stub)
                 self.set_response(scenario_name, session_name, response_id,
                                   stub.response())
@@ -484,6 +701,7 @@ class Cache(object):
 
                 # replace response text with response hash ids for session cache
             stub.response().pop('body', None)
+            stub.response().pop('templated', None)
             stub.response()['ids'] = response_ids
             delay_policy_name = stub.delay_policy()
             if delay_policy_name:
@@ -499,9 +717,22 @@ class Cache(object):
             # _id = ObjectId(scenario_stub['_id'])
             # stub['recorded'] = str(_id.generation_time.date())
             cache_info.append(stub.payload)
+        # the stubs are stored before the session that refers to them
+        self.set_raw(self.get_stubs_key(scenario_name),
+                     '{0}:{1}'.format(session_name, session['version']),
+                     json.dumps(cache_info, separators=(',', ':')))
+        session.pop('stubs', None)
+        self.set_session(scenario_name, session_name, session)
+        if previous_version:
+            self.get_cache_backend()(get_redis_master()).delete(
+                self.get_stubs_key(scenario_name),
+                '{0}:{1}'.format(session_name, previous_version))
         session['stubs'] = cache_info
-        # log.debug('stubs: {0}'.format(session['stubs']))
-        self.set(scenario_key, session_name, session)
+        session_stubs.set((scenario_key, session_name, session['version']),
+                          cache_info)
+        from stubo.match.compiler import get_compiled_session
+
+        get_compiled_session(session)
         log.debug('created session cache: {0}:{1}'.format(session['scenario'],
                                                           session['session']))
         return session
@@ -539,31 +770,37 @@ def get_request_index_hash_key(session, stub_number):
 
 
 def add_request(session, request_id, stub, system_date, stub_number,
-                request_cache_limit=10):
+                request_cache_limit=10, normalised_request_id=None):
+    """Cache the stub matched by a request, also under the normalised request
+    id if one is supplied. At most request_cache_limit request ids are cached
+    for the same response ids, the least recently used ones are evicted to
+    make room."""
     scenario_key = session['scenario']
     session_name = session['session']
     host, scenario_name = scenario_key.split(':')
     cache = Cache(host)
-    request_key = '{0}:{1}'.format(session_name, request_id)
     request_index_key = get_request_index_hash_key(session, stub_number)
-
-    request_values = cache.get_cache_backend()(get_redis_slave()).values(cache.get_request_key(
-        scenario_name))
-    cached_requests = [x for x in request_values if stub.response_ids() == x[0]]
-    if len(cached_requests) < request_cache_limit:
-        # Note only cache the first of request_cache_limit requests that have 
-        # the same response. Stops memory exhaustion if a test generates a 
-        # unique request each time.
-        result = cache.set(cache.get_request_key(scenario_name),
-                           request_key,
-                           (stub.response_ids(), stub.delay_policy_name(),
-                            stub.recorded(), system_date, stub.module(),
-                            request_index_key))
-        log.debug('add_request: {0} {1} {2} {3} {4} stub_number={5} '
-                  'request_index_key={6}, result={7}'.format(scenario_key,
-                                                             session_name, request_id, stub.response_ids(),
-                                                             stub.delay_policy_name(), stub_number, request_index_key,
-                                                             result))
+    cached_request = (stub.response_ids(), stub.delay_policy_name(),
+                      stub.recorded(), system_date, stub.module(),
+                      request_index_key)
+    request_ids = [request_id]
+    if normalised_request_id and normalised_request_id != request_id:
+        request_ids.append(normalised_request_id)
+    lru_key = cache.get_request_lru_key(scenario_name, session_name,
+                                        stub.response_ids())
+    evicted = cache.get_cache_backend()(get_redis_master()).set_lru(
+        cache.get_request_key(scenario_name), lru_key, request_ids,
+        cached_request, request_cache_limit,
+        prefix='{0}:'.format(session_name),
+        index_name=cache.get_request_lrus_key(scenario_name),
+        index_value=session_name)
+    if evicted:
+        counters.incr('request_cache.eviction', len(evicted))
+    log.debug('add_request: {0} {1} {2} {3} {4} stub_number={5} '
+              'request_index_key={6}, evicted={7}'.format(
+                  scenario_key, session_name, request_id, stub.response_ids(),
+                  stub.delay_policy_name(), stub_number, request_index_key,
+                  len(evicted)))
     return request_index_key
 
 
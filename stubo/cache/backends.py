@@ -1,6 +1,7 @@
-import os
 import json
-from stubo.cache.queue import redis_server
+import time
+from redis.client import Script
+from stubo.cache.queue import get_redis_slave
 
 __author__ = 'karolisrusenas'
 
@@ -46,19 +47,29 @@ class CacheBackend(object):
     def exists(self, name, key):
         raise NotImplementedError
 
+    def touch(self, name, key, score=None, hash_name=None, hash_key=None):
+        raise NotImplementedError
+
+    def set_lru(self, name, lru_name, keys, msg, size, prefix='',
+                index_name=None, index_value=''):
+        raise NotImplementedError
+
+    def get_cached_response(self, host, scenario_name, session_name,
+                            request_ids):
+        raise NotImplementedError
+
+    def next_response(self, index_name, index_key, name, keys):
+        raise NotImplementedError
+
+    def publish(self, channel, msg):
+        raise NotImplementedError
+
 
 class RedisCacheBackend(CacheBackend):
     def __init__(self, server=None):
-        # trying to get server from environment variables
-        redis_hostname = os.getenv("REDIS_ADDRESS", None)
-        redis_port = os.getenv("REDIS_PORT", None)
-        redis_password = os.getenv("REDIS_PASSWORD", None)
-
-        if redis_hostname and redis_port:
-            from stubo.utils import setup_redis
-            self.server = setup_redis(host=redis_hostname, port=int(redis_port), password=redis_password)
-        else:
-            self.server = server or redis_server
+        # the servers set up by stubo.utils.start_redis share their connection
+        # pools, REDIS_ADDRESS and REDIS_PORT are applied there
+        self.server = server or get_redis_slave()
 
     def get(self, name, key):
         try:
@@ -111,6 +122,149 @@ class RedisCacheBackend(CacheBackend):
     def exists(self, name, key):
         return self.server.hexists(name, key)
 
+    def touch(self, name, key, score=None, hash_name=None, hash_key=None):
+        """
+        Sets the score of key in the sorted set stored at name, the current
+        time by default.
+
+        If hash_name is given the score is only set while hash_key is in the
+        hash stored there, checked in one atomic script, so a key evicted
+        meanwhile is not added back.
+        """
+        score = score or time.time()
+        if hash_name is None:
+            return self.server.zadd(name, **{key: score})
+        return _touch_script(keys=[name, hash_name],
+                             args=[score, key, hash_key], client=self.server)
+
+    def set_lru(self, name, lru_name, keys, msg, size, prefix='',
+                index_name=None, index_value=''):
+        """
+        Sets prefix + key to msg in the hash stored at name for each of keys
+        and marks the keys used now in the sorted set stored at lru_name. The
+        least recently used keys beyond size are then removed from both.
+        Returns the keys removed.
+
+        If index_name is given lru_name is also set to index_value in the
+        hash stored there, so the sorted sets can be found without KEYS.
+
+        Runs as one atomic script, a single round trip whatever the size.
+        """
+        names = [name, lru_name]
+        if index_name:
+            names.append(index_name)
+        return _set_lru_script(keys=names,
+                               args=[time.time(), size, json.dumps(msg),
+                                     prefix, index_value] + list(keys),
+                               client=self.server)
+
+    def get_cached_response(self, host, scenario_name, session_name,
+                            request_ids):
+        """
+        Looks up the scenario of a session if scenario_name is None, the first
+        of request_ids cached for the session, its response if there is only
+        one and its delay policy. Returns
+            scenario_name, request_id, cached_request, response, delay_policy
+        with None for the values not found.
+
+        Once the scenario is known the rest is read by one script, a single
+        round trip, with all the keys it reads declared to redis.
+        """
+        if not scenario_name:
+            scenario_name = self.server.hget('{0}:sessions'.format(host),
+                                             session_name)
+            if not scenario_name:
+                return [None] * 5
+        scenario_key = '{0}:{1}'.format(host, scenario_name)
+        result = _get_cached_response_script(
+            keys=['{0}:request'.format(scenario_key),
+                  '{0}:response'.format(scenario_key),
+                  '{0}:delay_policy'.format(host)],
+            args=[session_name] + list(request_ids), client=self.server)
+        result += [None] * (4 - len(result))
+        return [scenario_name, result[0]] + [json.loads(x) if x else None
+                                             for x in result[1:]]
+
+    def next_response(self, index_name, index_key, name, keys):
+        """
+        Moves the index stored at index_key in the hash index_name on to the
+        next of keys, staying on the last one once it is reached, and returns
+        the value of that key in the hash name. The index counts from 1, 0
+        or no index starts from the first key.
+
+        Runs as one atomic script, concurrent callers each get the next value.
+        """
+        return json.loads(_next_response_script(
+            keys=[index_name, name], args=[index_key] + list(keys),
+            client=self.server) or 'null')
+
+    def publish(self, channel, msg):
+        """
+        Publishes msg as json on channel, returns the number of subscribers
+        that received it. Replicas pass published messages on to their own
+        subscribers after the writes that preceded them.
+        """
+        return self.server.publish(channel, json.dumps(msg))
+
+
+_set_lru_script = Script(None, """
+local now, size, msg, prefix = ARGV[1], tonumber(ARGV[2]), ARGV[3], ARGV[4]
+if KEYS[3] then
+    redis.call('HSET', KEYS[3], KEYS[2], ARGV[5])
+end
+for i = 6, #ARGV do
+    redis.call('HSET', KEYS[1], prefix .. ARGV[i], msg)
+    redis.call('ZADD', KEYS[2], now, ARGV[i])
+end
+local excess = redis.call('ZCARD', KEYS[2]) - size
+if excess <= 0 then
+    return {}
+end
+local removed = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+for _, key in ipairs(removed) do
+    redis.call('HDEL', KEYS[1], prefix .. key)
+end
+return removed
+""")
+
+_touch_script = Script(None, """
+if redis.call('HEXISTS', KEYS[2], ARGV[3]) == 1 then
+    return redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+""")
+
+_get_cached_response_script = Script(None, """
+local session = ARGV[1]
+for i = 2, #ARGV do
+    local cached = redis.call('HGET', KEYS[1], session .. ':' .. ARGV[i])
+    if cached then
+        local request = cjson.decode(cached)
+        local response_ids, delay_policy_name = request[1], request[2]
+        local response, delay_policy = false, false
+        if #response_ids == 1 then
+            response = redis.call('HGET', KEYS[2],
+                                  session .. ':' .. response_ids[1])
+        end
+        if type(delay_policy_name) == 'string' and
+                delay_policy_name ~= '' then
+            delay_policy = redis.call('HGET', KEYS[3], delay_policy_name)
+        end
+        return {ARGV[i], cached, response, delay_policy}
+    end
+end
+return {}
+""")
+
+_next_response_script = Script(None, """
+local index = tonumber(redis.call('HGET', KEYS[1], ARGV[1])) or 0
+local count = #ARGV - 1
+if index < count then
+    index = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+end
+return redis.call('HGET', KEYS[2], ARGV[math.min(index, count) + 1])
+""")
 
 redis_master_server = None
 
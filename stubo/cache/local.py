@@ -0,0 +1,158 @@
+"""
+    stubo.cache.local
+    ~~~~~~~~~~~~~~~~~
+
+    Process local copies of playback sessions and delay policies read from
+    redis, see :meth:`stubo.cache.Cache.get_session`.
+
+    Writers publish what they changed on :data:`channel` of the redis master,
+    see :meth:`stubo.cache.Cache.publish_invalidation`. Each process listens
+    on its local redis with a :class:`Subscriber` and drops its copies as the
+    messages arrive. A replica passes a message on after the writes that
+    preceded it so the data read after an invalidation is current.
+
+    The copies are only used while this process is subscribed, they are
+    dropped whenever it subscribes again as messages may have been missed.
+
+    :copyright: (c) 2015 by OpenCredo.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import redis
+
+from stubo.utils.lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+channel = 'stubo:invalidate'
+
+# sessions with their stubs keyed by (scenario_key, session_name)
+sessions = LRUCache(1000, 'session_cache')
+# delay policies keyed by (delay_policy_key, name)
+delay_policies = LRUCache(1000, 'delay_policy_cache')
+
+_lock = threading.Lock()
+# incremented by every invalidation, see remember
+_generation = 0
+# pid of the process whose subscriber is listening
+_subscribed_pid = None
+
+
+def active():
+    """True if the subscriber of this process is listening, processes forked
+    from it (the worker process pool) do not inherit it."""
+    return _subscribed_pid == os.getpid()
+
+
+def generation():
+    """Take before reading the value to pass to :func:`remember`."""
+    return _generation
+
+
+def remember(cache, key, value, read_generation):
+    """Keep a value read from redis unless an invalidation arrived since
+    read_generation was taken, the value may be stale then."""
+    with _lock:
+        if active() and read_generation == _generation:
+            cache.set(key, value)
+
+
+def invalidate(message):
+    """Drop the copies named by an invalidation message.
+
+     :Params:
+      - `message`: dict with either
+          - `scenario` key and optional `session` name, all sessions of the
+            scenario if the session is None, and the `version` of the session
+            set if any, its compiled session is kept
+          - `delay_policy` key and optional list of `names`, all the delay
+            policies of the key if names is None
+    """
+    global _generation
+    from stubo.match.compiler import invalidate_compiled_session
+
+    scenario_key = message.get('scenario')
+    session_name = message.get('session')
+    version = message.get('version')
+    delay_policy_key = message.get('delay_policy')
+    names = message.get('names')
+    with _lock:
+        _generation += 1
+        if scenario_key:
+            sessions.discard(lambda k: k[0] == scenario_key and (
+                session_name is None or k[1] == session_name))
+        if delay_policy_key:
+            delay_policies.discard(lambda k: k[0] == delay_policy_key and (
+                names is None or k[1] in names))
+    if scenario_key:
+        invalidate_compiled_session(scenario_key, session_name,
+                                    keep_version=version)
+
+
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        sessions.clear()
+        delay_policies.clear()
+
+
+def set_subscribed(subscribed):
+    global _subscribed_pid
+    with _lock:
+        _subscribed_pid = os.getpid() if subscribed else None
+    clear()
+
+
+class Subscriber(threading.Thread):
+    """Daemon thread applying the invalidation messages published on
+    :data:`channel`. Start one in each process after forking.
+    """
+
+    def __init__(self, server, retry_interval=1):
+        threading.Thread.__init__(self, name='stubo-invalidation')
+        self.daemon = True
+        # a connection of its own that waits for messages without a timeout
+        pool = server.connection_pool
+        kwargs = dict(pool.connection_kwargs, socket_timeout=None)
+        self.server = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=pool.connection_class, **kwargs))
+        self.retry_interval = retry_interval
+
+    def run(self):
+        while True:
+            pubsub = self.server.pubsub()
+            try:
+                pubsub.subscribe(channel)
+                for message in pubsub.listen():
+                    self.handle(message)
+            except Exception, e:
+                log.warn('lost invalidation channel, subscribing again in {0} '
+                         'secs: {1}'.format(self.retry_interval, e))
+            set_subscribed(False)
+            pubsub.reset()
+            time.sleep(self.retry_interval)
+
+    def handle(self, message):
+        if message['type'] == 'subscribe':
+            # also sent after redis-py reconnected on its own
+            log.info('subscribed to {0}'.format(channel))
+            set_subscribed(True)
+        elif message['type'] == 'message':
+            try:
+                invalidate(json.loads(message['data']))
+            except (ValueError, AttributeError), e:
+                log.warn('ignored invalidation message {0}: {1}'.format(
+                    message['data'], e))
+
+
+def subscribe(server, retry_interval=1):
+    """Start the :class:`Subscriber` of this process."""
+    subscriber = Subscriber(server, retry_interval)
+    subscriber.start()
+    return subscriber
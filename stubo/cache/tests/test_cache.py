@@ -1,6 +1,6 @@
 import unittest
 import mock
-from stubo.testing import DummyHash
+from stubo.testing import DummyHash, make_cache_stub
 
 
 class Base(unittest.TestCase):
@@ -51,7 +51,7 @@ class Test_create_session_cache(Base):
         self.scenario.insert_stub(doc, stateful=True)
         cache = self._get_cache()
         cache.create_session_cache('foo', 'bar')
-        session = self.hash.get('localhost:foo', 'bar')
+        session = cache.get_session('foo', 'bar')
         self.assertEqual(session["status"], "playback")
         self.assertEqual(session['session'], 'bar')
         self.assertEqual(session["scenario"], "localhost:foo")
@@ -65,6 +65,75 @@ class Test_create_session_cache(Base):
         self.assertEqual(stub.response_ids(), [response_hash('<test>OK</test>', stub)])
         self.assertEqual(self.hash.get_raw('localhost:sessions', 'bar'), 'foo')
 
+    def test_new_session_version(self):
+        self._make_scenario('localhost:foo')
+        from stubo.model.stub import create, Stub
+
+        stub = Stub(create('<test>match this</test>', '<test>OK</test>'),
+                    'localhost:foo')
+        doc = dict(scenario='localhost:foo', stub=stub)
+        self.scenario.insert_stub(doc, stateful=True)
+        cache = self._get_cache()
+        first = cache.create_session_cache('foo', 'bar')['version']
+        second = cache.create_session_cache('foo', 'bar')['version']
+        self.assertTrue(first)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.hash.get('localhost:foo', 'bar')['version'],
+                         second)
+        from stubo.match.compiler import get_compiled_session
+        compiled = get_compiled_session(cache.get_session('foo', 'bar'))
+        self.assertEqual(compiled.version, second)
+
+    def test_new_session_stubs_stored_per_version(self):
+        from stubo.cache import session_stubs
+        from stubo.model.stub import create, Stub
+
+        self._make_scenario('localhost:foo')
+        stub = Stub(create('<test>match this</test>', '<test>OK</test>'),
+                    'localhost:foo')
+        self.scenario.insert_stub(dict(scenario='localhost:foo', stub=stub),
+                                  stateful=True)
+        cache = self._get_cache()
+        cache.create_session_cache('foo', 'bar')
+        version = cache.create_session_cache('foo', 'bar')['version']
+        self.assertFalse('stubs' in self.hash.get('localhost:foo', 'bar'))
+        self.assertEqual(self.hash.keys('localhost:foo:stubs'),
+                         ['bar:{0}'.format(version)])
+        stubs = self.hash.get('localhost:foo:stubs',
+                              'bar:{0}'.format(version))
+        session_stubs.clear()
+        self.assertEqual(cache.get_session('foo', 'bar')['stubs'], stubs)
+        with mock.patch.object(cache, 'get') as get:
+            self.assertTrue(cache.get_session_stubs('foo', 'bar', version)
+                            is cache.get_session_stubs('foo', 'bar', version))
+        self.assertFalse(get.called)
+        self.assertFalse('stubs' in cache.get_session('foo', 'bar',
+                                                      stubs=False))
+
+    def test_new_session_templated_responses(self):
+        self._make_scenario('localhost:foo')
+        from stubo.model.stub import create, Stub, response_hash
+
+        for i, response in enumerate(['<test>OK</test>',
+                                      '<test>{{1+1}}</test>']):
+            stub = Stub(create('<test>match {0}</test>'.format(i), response),
+                        'localhost:foo')
+            doc = dict(scenario='localhost:foo', stub=stub)
+            self.scenario.insert_stub(doc, stateful=True)
+        cache = self._get_cache()
+        cache.create_session_cache('foo', 'bar')
+        stubs = cache.get_session('foo', 'bar')['stubs']
+        self.assertFalse([x for x in stubs if 'templated' in x['response']])
+        templated = {}
+        for stub in stubs:
+            response_id = stub['response']['ids'][0]
+            response = self.hash.get('localhost:foo:response',
+                                     'bar:{0}'.format(response_id))
+            matcher = stub['request']['bodyPatterns']['contains'][0]
+            templated[matcher] = response['templated']
+        self.assertEqual(templated, {'<test>match 0</test>': False,
+                                     '<test>match 1</test>': True})
+
     def test_new_session_with_state(self):
         scenario_name = 'foo'
         self._make_scenario('localhost:foo')
@@ -82,7 +151,7 @@ class Test_create_session_cache(Base):
 
         cache = self._get_cache()
         cache.create_session_cache('foo', 'bar')
-        session = self.hash.get('localhost:foo', 'bar')
+        session = cache.get_session('foo', 'bar')
         self.assertEqual(session["status"], "playback")
         self.assertEqual(session['session'], 'bar')
         self.assertEqual(session["scenario"], "localhost:foo")
@@ -115,7 +184,7 @@ class Test_create_session_cache(Base):
 
         cache = self._get_cache()
         cache.create_session_cache('foo', 'bar')
-        session = self.hash.get('localhost:foo', 'bar')
+        session = cache.get_session('foo', 'bar')
         self.assertEqual(session["status"], "playback")
         self.assertEqual(session['session'], 'bar')
         self.assertEqual(session["scenario"], "localhost:foo")
@@ -148,7 +217,7 @@ class Test_create_session_cache(Base):
         self.scenario.insert_stub(doc, stateful=True)
 
         self._get_cache().create_session_cache('foo', 'bar')
-        session = self.hash.get('localhost:foo', 'bar')
+        session = self._get_cache().get_session('foo', 'bar')
         self.assertTrue('stubs' in session)
         stubs = session['stubs']
         self.assertEqual(len(stubs), 1)
@@ -172,7 +241,7 @@ class Test_create_session_cache(Base):
         doc = dict(scenario='localhost:foo', stub=stub)
         self.scenario.insert_stub(doc, stateful=True)
         self._get_cache().create_session_cache('foo', 'bar')
-        session = self.hash.get('localhost:foo', 'bar')
+        session = self._get_cache().get_session('foo', 'bar')
         self.assertTrue('stubs' in session)
         stubs = session['stubs']
         self.assertEqual(len(stubs), 1)
@@ -358,6 +427,54 @@ class TestCache(unittest.TestCase):
                          ["1", ""])
 
 
+    def test_lookup_request_normalised(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+        self.hash.set('localhost:foo:request', 'bar:2', ["2", ""])
+        cache = self._get_cache()
+        self.assertEqual(cache.lookup_request('foo', 'bar', '1'), None)
+        self.assertEqual(cache.lookup_request('foo', 'bar', '1', '2'),
+                         ["2", ""])
+        self.assertEqual(counters.get('request_cache.miss'), 2)
+        self.assertEqual(counters.get('request_cache.normalised_hit'), 1)
+
+    def test_evicted_request_not_touched(self):
+        from stubo.cache import recently_used
+        recently_used.clear()
+        cache = self._get_cache()
+        lru_key = cache.get_request_lru_key('foo', 'bar', ['1'])
+        cache.touch_request('foo', 'bar', '1', ['1'])
+        self.assertEqual(self.hash.keys(lru_key), [])
+        self.hash.set('localhost:foo:request', 'bar:2', [["1"], ""])
+        cache.touch_request('foo', 'bar', '2', ['1'])
+        self.assertEqual(self.hash.keys(lru_key), ['2'])
+
+    def test_lookup_response(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+        self.hash.set_raw('localhost:sessions', 'bar', 'foo')
+        self.hash.set('localhost:foo:request', 'bar:2',
+                      [["r1"], "slow", None, "2013-09-05", {}, "x"])
+        self.hash.set('localhost:foo:response', 'bar:r1', {'body': 'hello'})
+        self.hash.set('localhost:delay_policy', 'slow', {'name': 'slow'})
+        cache = self._get_cache()
+        self.assertEqual(cache.lookup_response('bar', '1'),
+                         ('foo', None, None, None))
+        self.assertEqual(cache.lookup_response('bar', '1', '2'),
+                         ('foo', [["r1"], "slow", None, "2013-09-05", {}, "x"],
+                          {'body': 'hello'}, {'name': 'slow'}))
+        self.assertEqual(cache.lookup_response('bar', '2',
+                                               scenario_name='foo')[0], 'foo')
+        self.assertEqual(counters.get('request_cache.miss'), 2)
+        self.assertEqual(counters.get('request_cache.hit'), 1)
+        self.assertEqual(counters.get('request_cache.normalised_hit'), 1)
+
+    def test_lookup_response_session_not_found(self):
+        from stubo.exceptions import HTTPClientError
+        with self.assertRaises(HTTPClientError):
+            self._get_cache().lookup_response('bar', '1')
+
+
 class Test_get_response_text(unittest.TestCase):
     '''
     redis> hgetall "localhost:first:response"
@@ -400,6 +517,15 @@ class Test_get_response_text(unittest.TestCase):
         self.assertEqual(self._func('foo', 'bar', ['1', '2'], '1'),
                          "Hello {{1+1}} World 2")
 
+    def test_with_state_reset(self):
+        self.hash.set('localhost:foo:response', 'bar:1', "1")
+        self.hash.set('localhost:foo:response', 'bar:2', "2")
+        self.hash.set('localhost:foo:response', 'bar:3', "3")
+        self.assertEqual([self._func('foo', 'bar', ['1', '2', '3'], 'x')
+                          for _ in range(4)], ["1", "2", "3", "3"])
+        self._get_cache().set_request_index_item('foo', 'bar:x', 0)
+        self.assertEqual(self._func('foo', 'bar', ['1', '2', '3'], 'x'), "1")
+
     def test_not_found(self):
         self.assertEqual(self._func('foo', 'bar', ['1'], '2'), None)
 
@@ -499,6 +625,117 @@ class Test_add_request(Base):
             self._func(session, stub, request_id='{0}'.format(i))
         self.assertEqual(len(self.hash.get_all('localhost:foo:request')), 11)
 
+    def test_least_recently_used_evicted(self):
+        from stubo.cache import recently_used
+        from stubo.model.stub import create, Stub
+
+        recently_used.clear()
+        self._make_scenario('localhost:foo')
+        stub = Stub(create('<test>match this</test>', '<test>OK</test>'),
+                    'localhost:foo')
+        self.scenario.insert_stub(dict(scenario='localhost:foo', stub=stub),
+                                  stateful=True)
+        cache = self._get_cache()
+        session = cache.create_session_cache('foo', 'bar')
+        with mock.patch('time.time', return_value=1):
+            for i in range(10):
+                self._func(session, stub, request_id='{0}'.format(i))
+        with mock.patch('time.time', return_value=2):
+            self.assertTrue(cache.lookup_request('foo', 'bar', '0'))
+            self._func(session, stub, request_id='10')
+        requests = self.hash.get_all('localhost:foo:request')
+        self.assertEqual(len(requests), 10)
+        self.assertTrue('bar:0' in requests)
+        self.assertFalse('bar:1' in requests)
+
+    def test_lru_deleted_with_session(self):
+        self._make_scenario('localhost:foo')
+        from stubo.model.stub import create, Stub
+
+        stub = Stub(create('<test>match this</test>', '<test>OK</test>'),
+                    'localhost:foo')
+        self.scenario.insert_stub(dict(scenario='localhost:foo', stub=stub),
+                                  stateful=True)
+        cache = self._get_cache()
+        session = cache.create_session_cache('foo', 'bar')
+        self._func(session, stub)
+        lru_key = cache.get_request_lru_key('foo', 'bar', ['1'])
+        self.assertEqual(self.hash.keys('localhost:foo:request_lrus'),
+                         [lru_key])
+        self.assertTrue(lru_key in self.hash._keys)
+        cache.delete_session_data('foo', 'bar')
+        self.assertFalse(lru_key in self.hash._keys)
+        self.assertEqual(self.hash.keys('localhost:foo:request_lrus'), [])
+
+
+class TestRedisScripts(unittest.TestCase):
+
+    def _backend(self, result):
+        from stubo.cache.backends import RedisCacheBackend
+        server = mock.Mock()
+        server.evalsha.return_value = result
+        return RedisCacheBackend(server), server
+
+    def test_next_response(self):
+        backend, server = self._backend('{"body": "2"}')
+        self.assertEqual(backend.next_response('foo:request_index', 'bar:x',
+                                               'foo:response',
+                                               ['bar:1', 'bar:2']),
+                         {'body': '2'})
+        args = server.evalsha.call_args[0]
+        self.assertEqual(args[1:], (2, 'foo:request_index', 'foo:response',
+                                    'bar:x', 'bar:1', 'bar:2'))
+
+    def test_next_response_not_found(self):
+        backend, _ = self._backend(None)
+        self.assertEqual(backend.next_response('a', 'b', 'c', ['d', 'e']),
+                         None)
+
+    def test_set_lru_indexed(self):
+        backend, server = self._backend([])
+        with mock.patch('stubo.cache.backends.time.time', return_value=1):
+            self.assertEqual(backend.set_lru('foo:request', 'foo:lru', ['1'],
+                                             [['2'], ''], 10, prefix='bar:',
+                                             index_name='foo:lrus',
+                                             index_value='bar'), [])
+        self.assertEqual(server.evalsha.call_args[0][1:],
+                         (3, 'foo:request', 'foo:lru', 'foo:lrus', 1, 10,
+                          '[["2"], ""]', 'bar:', 'bar', '1'))
+
+    def test_touch_only_cached(self):
+        backend, server = self._backend(1)
+        self.assertEqual(backend.touch('foo:lru', '1', 5,
+                                       hash_name='foo:request',
+                                       hash_key='bar:1'), 1)
+        self.assertEqual(server.evalsha.call_args[0][1:],
+                         (2, 'foo:lru', 'foo:request', 5, '1', 'bar:1'))
+        backend.touch('foo:lru', '1', 5)
+        server.zadd.assert_called_once_with('foo:lru', **{'1': 5})
+
+    def test_get_cached_response(self):
+        backend, server = self._backend(['2', '[["1"], ""]',
+                                         '{"body": "x"}', None])
+        server.hget.return_value = 'foo'
+        self.assertEqual(backend.get_cached_response('localhost', None, 'bar',
+                                                     ['1', '2']),
+                         ['foo', '2', [['1'], ''], {'body': 'x'}, None])
+        server.hget.assert_called_once_with('localhost:sessions', 'bar')
+        self.assertEqual(server.evalsha.call_args[0][1:],
+                         (3, 'localhost:foo:request', 'localhost:foo:response',
+                          'localhost:delay_policy', 'bar', '1', '2'))
+        server.evalsha.return_value = []
+        self.assertEqual(backend.get_cached_response('localhost', 'foo', 'bar',
+                                                     ['1']),
+                         ['foo'] + [None] * 4)
+        self.assertEqual(server.hget.call_count, 1)
+
+    def test_get_cached_response_session_not_found(self):
+        backend, server = self._backend([])
+        server.hget.return_value = None
+        self.assertEqual(backend.get_cached_response('localhost', None, 'bar',
+                                                     ['1']), [None] * 5)
+        self.assertFalse(server.evalsha.called)
+
 
 class TestRequestIndex(unittest.TestCase):
     def setUp(self):
@@ -587,3 +824,91 @@ class DummyObjectId(object):
     @property
     def generation_time(self):
         return self.__dt
+
+
+class TestLocalCopies(unittest.TestCase):
+    def setUp(self):
+        from stubo.cache import local
+        self.hash = DummyHash({})
+        self.patch = mock.patch('stubo.cache.RedisCacheBackend', self.hash)
+        self.patch.start()
+        local.set_subscribed(True)
+
+    def tearDown(self):
+        from stubo.cache import local
+        self.patch.stop()
+        local.set_subscribed(False)
+
+    def _get_cache(self):
+        from stubo.cache import Cache
+
+        return Cache('localhost')
+
+    def test_session(self):
+        cache = self._get_cache()
+        session = dict(status='playback', session='bar',
+                       scenario='localhost:foo')
+        cache.set_session('foo', 'bar', session)
+        self.assertEqual(cache.get_session('foo', 'bar'), session)
+        self.hash.set('localhost:foo', 'bar', dict(session, status='dormant'))
+        # kept until invalidated
+        self.assertEqual(cache.get_session('foo', 'bar')['status'], 'playback')
+        self.assertEqual(cache.get_session('foo', 'bar', local=False)['status'],
+                         'dormant')
+        cache.set_session('foo', 'bar', dict(session, status='dormant'))
+        self.assertEqual(cache.get_session('foo', 'bar')['status'], 'dormant')
+        self.assertEqual(self.hash.published[-1],
+                         ('stubo:invalidate', dict(scenario='localhost:foo',
+                                                   session='bar',
+                                                   version=None)))
+
+    def test_compiled_session_kept_on_own_message(self):
+        from stubo.cache import local
+        from stubo.match.compiler import (
+            get_compiled_session, invalidate_compiled_session
+        )
+        self.addCleanup(invalidate_compiled_session, 'localhost:foo')
+        cache = self._get_cache()
+        session = dict(status='playback', session='bar',
+                       scenario='localhost:foo', version='2',
+                       stubs=[make_cache_stub(['x'], [1])])
+        cache.set_session('foo', 'bar', session)
+        compiled = get_compiled_session(session)
+        # received back by the subscriber of this process
+        local.invalidate(self.hash.published[-1][1])
+        self.assertTrue(compiled is get_compiled_session(session))
+        local.invalidate(dict(self.hash.published[-1][1], version='3'))
+        self.assertFalse(compiled is get_compiled_session(session))
+
+    def test_session_copy_returned(self):
+        cache = self._get_cache()
+        cache.set_session('foo', 'bar', dict(status='playback'))
+        cache.get_session('foo', 'bar')['ext_cache'] = None
+        self.assertEqual(cache.get_session('foo', 'bar'),
+                         dict(status='playback'))
+
+    def test_delete_caches(self):
+        cache = self._get_cache()
+        cache.set_session('foo', 'bar', dict(status='playback'))
+        cache.get_session('foo', 'bar')
+        cache.delete_caches('foo')
+        self.assertEqual(cache.get_session('foo', 'bar'), {})
+        self.assertEqual(self.hash.published[-1],
+                         ('stubo:invalidate', dict(scenario='localhost:foo',
+                                                   session=None)))
+
+    def test_delay_policy(self):
+        cache = self._get_cache()
+        cache.set_delay_policy('slow', dict(name='slow', milliseconds=10))
+        self.assertEqual(cache.get_delay_policy('slow')['milliseconds'], 10)
+        self.hash.set('localhost:delay_policy', 'slow',
+                      dict(name='slow', milliseconds=20))
+        self.assertEqual(cache.get_delay_policy('slow')['milliseconds'], 10)
+        cache.set_delay_policy('slow', dict(name='slow', milliseconds=30))
+        self.assertEqual(cache.get_delay_policy('slow')['milliseconds'], 30)
+        cache.delete_delay_policy(['slow'])
+        self.assertEqual(cache.get_delay_policy('slow'), None)
+        self.assertEqual(self.hash.published[-1],
+                         ('stubo:invalidate', dict(
+                             delay_policy='localhost:delay_policy',
+                             names=['slow'])))
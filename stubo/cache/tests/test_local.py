@@ -0,0 +1,104 @@
+import unittest
+import json
+import mock
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        from stubo.cache import local
+        local.set_subscribed(True)
+
+    def tearDown(self):
+        from stubo.cache import local
+        local.set_subscribed(False)
+
+    def test_remember(self):
+        from stubo.cache.local import sessions, remember, generation
+        remember(sessions, ('localhost:foo', 'bar'), {'a': 1}, generation())
+        self.assertEqual(sessions.get(('localhost:foo', 'bar')), {'a': 1})
+
+    def test_not_remembered_after_invalidation(self):
+        from stubo.cache.local import sessions, remember, generation, \
+            invalidate
+        read_generation = generation()
+        invalidate(dict(scenario='localhost:other'))
+        remember(sessions, ('localhost:foo', 'bar'), {'a': 1}, read_generation)
+        self.assertFalse(('localhost:foo', 'bar') in sessions)
+
+    def test_not_remembered_unless_subscribed(self):
+        from stubo.cache.local import sessions, remember, generation, \
+            set_subscribed
+        set_subscribed(False)
+        remember(sessions, ('localhost:foo', 'bar'), {'a': 1}, generation())
+        self.assertFalse(('localhost:foo', 'bar') in sessions)
+
+    def test_not_active_in_forked_process(self):
+        from stubo.cache.local import active
+        self.assertTrue(active())
+        with mock.patch('stubo.cache.local.os.getpid', return_value=-1):
+            self.assertFalse(active())
+
+    def test_invalidate_session(self):
+        from stubo.cache.local import sessions, invalidate
+        for key in (('localhost:foo', 'bar'), ('localhost:foo', 'bar2'),
+                    ('localhost:foo2', 'bar')):
+            sessions.set(key, {})
+        with mock.patch('stubo.match.compiler.invalidate_compiled_session'
+                        ) as invalidate_compiled:
+            invalidate(dict(scenario='localhost:foo', session='bar',
+                            version='1'))
+        invalidate_compiled.assert_called_once_with('localhost:foo', 'bar',
+                                                    keep_version='1')
+        self.assertEqual(len(sessions), 2)
+        self.assertFalse(('localhost:foo', 'bar') in sessions)
+        invalidate(dict(scenario='localhost:foo', session=None))
+        self.assertEqual(len(sessions), 1)
+        self.assertTrue(('localhost:foo2', 'bar') in sessions)
+
+    def test_invalidate_delay_policy(self):
+        from stubo.cache.local import delay_policies, invalidate
+        for name in ('slow', 'fast'):
+            delay_policies.set(('localhost:delay_policy', name), {})
+        invalidate(dict(delay_policy='localhost:delay_policy',
+                        names=['slow']))
+        self.assertEqual(len(delay_policies), 1)
+        invalidate(dict(delay_policy='localhost:delay_policy', names=None))
+        self.assertEqual(len(delay_policies), 0)
+
+
+class TestSubscriber(unittest.TestCase):
+
+    def tearDown(self):
+        from stubo.cache import local
+        local.set_subscribed(False)
+
+    def _get_subscriber(self):
+        from stubo.cache.local import Subscriber
+        server = mock.Mock()
+        server.connection_pool.connection_kwargs = dict(host='localhost',
+                                                        socket_timeout=5)
+        with mock.patch('stubo.cache.local.redis') as redis:
+            subscriber = Subscriber(server)
+        pool_kwargs = redis.ConnectionPool.call_args[1]
+        self.assertEqual(pool_kwargs['socket_timeout'], None)
+        return subscriber
+
+    def test_subscribed(self):
+        from stubo.cache.local import active, sessions
+        subscriber = self._get_subscriber()
+        sessions.set(('localhost:foo', 'bar'), {})
+        subscriber.handle(dict(type='subscribe', data=1))
+        self.assertTrue(active())
+        # messages may have been missed before (re)subscribing
+        self.assertEqual(len(sessions), 0)
+
+    def test_message(self):
+        from stubo.cache.local import sessions
+        subscriber = self._get_subscriber()
+        subscriber.handle(dict(type='subscribe', data=1))
+        sessions.set(('localhost:foo', 'bar'), {})
+        subscriber.handle(dict(type='message', data=json.dumps(dict(
+            scenario='localhost:foo', session='bar'))))
+        self.assertEqual(len(sessions), 0)
+        subscriber.handle(dict(type='message', data='not json'))
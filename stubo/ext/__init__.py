@@ -10,6 +10,8 @@
 from datetime import date, datetime, timedelta
 import logging
 from lxml import etree
+from jsonpath_rw import parse as jsonpath_parse
+from stubo.utils.lru import LRUCache
 from .parse_date import parse_date_string
 
 log = logging.getLogger(__name__)
@@ -33,6 +35,25 @@ def parse_xml(xml):
     return doc
 
 
+#: compiled XPath and parsed JSONPath expressions, shared by matchers and
+#: exits, hits are compilations saved
+xpath_cache = LRUCache(1000, 'xpath_cache')
+jsonpath_cache = LRUCache(1000, 'jsonpath_cache')
+
+
+def compile_xpath(xpath, namespaces=None):
+    """ Return a compiled :class:`lxml.etree.XPath` for an expression """
+    namespaces = namespaces or {}
+    key = xpath, tuple(sorted(namespaces.iteritems()))
+    return xpath_cache.get_or_create(
+        key, lambda: etree.XPath(xpath, namespaces=namespaces))
+
+
+def compile_jsonpath(expr):
+    """ Return a parsed jsonpath_rw expression """
+    return jsonpath_cache.get_or_create(expr, lambda: jsonpath_parse(expr))
+
+
 def today_str(fmt="%d%m%y"):
     return date.today().strftime(fmt)
 
@@ -28,6 +28,16 @@ class Hooks(object):
         hooks_cls = stubo.ext.transformer.StuboDefaultHooks
     """
 
+    #: True if the transformers made by these hooks return a new stub or
+    #: request instead of modifying the ones they are given (user exits
+    #: excepted). get/response then only copies stubs that have a module.
+    copy_on_write = False
+
+    #: True if the transformers made by these hooks leave stubs and
+    #: responses without module or template markup unchanged, so that
+    #: get/response can skip transforming them.
+    skip_static = False
+
     def make_transformer(self, stub):
         """ Factory method to create an instance of :class:`~stubo.ext.transformer.TransformerBase`
         
@@ -1,4 +1,5 @@
 import unittest
+import mock
 import datetime
 
 
@@ -128,3 +129,40 @@ class TestRollDate(unittest.TestCase):
         recorded = datetime.date(2014, 12, 10)
         result = self._roll('05Jan', recorded, 10, "%d%b")
         self.assertEqual(result, '15Jan')
+
+
+class TestCompilePaths(unittest.TestCase):
+    def test_compile_xpath_cached(self):
+        from stubo.ext import compile_xpath, parse_xml
+        ns = {'x': 'http://x'}
+        compiled = compile_xpath('//x:a', ns)
+        self.assertTrue(compile_xpath('//x:a', dict(ns)) is compiled)
+        self.assertFalse(compile_xpath('//x:a') is compiled)
+        doc = parse_xml('<b xmlns:x="http://x"><x:a>1</x:a></b>')
+        self.assertEqual([x.text for x in compiled(doc)], ['1'])
+
+    def test_compile_jsonpath_cached(self):
+        from stubo.ext import compile_jsonpath
+        compiled = compile_jsonpath('$.a')
+        self.assertTrue(compile_jsonpath('$.a') is compiled)
+        self.assertEqual([x.value for x in compiled.find({'a': 1})], [1])
+
+
+class TestTransformer(unittest.TestCase):
+    def _transform(self, module=None):
+        from stubo.ext.transformer import Transformer
+        from stubo.model.request import StuboRequest
+        from stubo.model.stub import Stub
+        from stubo.testing import DummyModel, make_stub
+        request = StuboRequest(DummyModel(body='<a><b>1</b></a>', headers={}))
+        stub = Stub(make_stub(['<b>1</b>'], 'x'), 'localhost:foo')
+        Transformer(stub, module=module).transform(
+            request, trace=mock.Mock(), function='put/stub', stage=None)
+        return request
+
+    def test_user_exit_gets_copy_of_xml(self):
+        def exits(request, context):
+            context['xmltree'].find('b').text = '2'
+
+        request = self._transform(mock.Mock(exits=exits))
+        self.assertEqual(request.request_body_xml().find('b').text, '1')
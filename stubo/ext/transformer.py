@@ -3,7 +3,7 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import logging
-from lxml import etree
+import copy
 from stubo.utils import as_date, compact_traceback, run_template
 from stubo.exceptions import TransformError
 from stubo.ext import roll_date, parse_xml, today_str
@@ -15,6 +15,9 @@ log = logging.getLogger(__name__)
 
 
 class StuboDefaultHooks(Hooks):
+    copy_on_write = True
+    skip_static = True
+
     def make_transformer(self, stub):
         module = None
         if stub.module():
@@ -23,6 +26,16 @@ class StuboDefaultHooks(Hooks):
         return Transformer(stub, module)
 
 
+def update_url_args(url_args, stub):
+    """ Merge the args recorded with the stub into the get/response args,
+    leaving out the names reserved for the transform context."""
+    unsafevars = ('request', 'function', 'cache', 'stage',
+                  'module_system_date', 'system_date', 'trace')
+    url_args.update(x for x in stub.args().iteritems() if x[0] not in ('session',))
+    for var in unsafevars:
+        url_args.pop(var, None)
+
+
 def transform(stub, request, **kwargs):
     function = kwargs['function']
     stage = kwargs.get('stage')
@@ -37,11 +50,7 @@ def transform(stub, request, **kwargs):
         system_date = kwargs.get('system_date')
         if isinstance(system_date, basestring):
             system_date = as_date('system_date')
-        unsafevars = ('request', 'function', 'cache', 'stage',
-                      'module_system_date', 'system_date', 'trace')
-        url_args.update(x for x in stub.args().iteritems() if x[0] not in ('session',))
-        for var in unsafevars:
-            url_args.pop(var, None)
+        update_url_args(url_args, stub)
 
         return transformer.transform(request,
                                      module_system_date=module_system_date,
@@ -102,7 +111,10 @@ class TransformerBase(object):
         context = dict(stub=stub, template_processor=self.template_processor)
         try:
             # if the request is XML parse and make it available for templates 
-            xmltree = etree.fromstring(request.request_body())
+            xmltree = request.request_body_xml()
+            if self.module:
+                # the parsed request is shared, user exits may change theirs
+                xmltree = copy.deepcopy(xmltree)
             context['xmltree'] = xmltree
         except Exception:
             pass
@@ -132,7 +144,9 @@ class TransformerBase(object):
                 # eval_text returns utf8 so decode to unicode again here
                 evaluated = self.eval_text(to_eval, request, **context)
                 decoded.append(evaluated.decode('utf8'))
-            if len(decoded):
+            if decoded != contained_matchers:
+                # copy on write, the stub may be shared with the session cache
+                stub = stub.copy()
                 stub.set_contains_matchers(decoded)
         return stub, request
 
@@ -6,7 +6,7 @@ import logging
 import os
 from lxml import etree
 from stubo.ext.user_exit import GetResponse, ExitResponse
-from stubo.ext import parse_xml, eye_catcher
+from stubo.ext import parse_xml, eye_catcher, compile_xpath
 from stubo.utils import run_template
 
 log = logging.getLogger(__name__)
@@ -262,7 +262,7 @@ class XMLMangler(object):
         args = dict()
         for name, path in elements_or_attrs.iteritems():
             if name not in excludes or path.extractor == ignore_children:
-                vals = xml_doc.xpath(path.xpath, namespaces=self.namespaces)
+                vals = compile_xpath(path.xpath, self.namespaces)(xml_doc)
                 # Note if the XPATH is not found we use the current 
                 # value if there is a match for this path.
                 value = '___stubo_ignore___'
@@ -11,69 +11,17 @@ import logging
 import copy
 
 from hamcrest.core.string_description import StringDescription
-from hamcrest import all_of, is_not
+from hamcrest import all_of
 
-from .request_matcher import (
-    body_contains, has_method, has_path, has_query_args, has_url_pattern,
-    body_xpath, body_jsonpath, has_headers
-)
+from .compiler import build_matchers, get_compiled_session
 from stubo.model.stub import StubCache
 from stubo.exceptions import exception_response
 from stubo.ext.transformer import transform
+from stubo.utils.stats import counters
 
 log = logging.getLogger(__name__)
 
 
-def build_matchers(stub):
-    matchers = []
-    for k, v in stub.request().iteritems():
-        if k == 'bodyPatterns':
-            body_patterns = stub.request()['bodyPatterns']
-            for body_pattern, body_pattern_value in body_patterns.iteritems():
-                # bodyPatterns is a list
-                for s in body_pattern_value:
-                    if body_pattern == 'contains':
-                        matchers.append(body_contains(s))
-                    elif body_pattern == '!contains':
-                        matchers.append(is_not(body_contains(s)))
-                    elif body_pattern == 'xpath':
-                        namespaces = None
-                        if isinstance(s, tuple):
-                            s, namespaces = s
-                        matchers.append(body_xpath(s, namespaces))
-                    elif body_pattern == '!xpath':
-                        namespaces = None
-                        if isinstance(s, tuple):
-                            s, namespaces = s
-                        matchers.append(is_not(body_xpath(s, namespaces)))
-                    elif body_pattern == 'jsonpath':
-                        matchers.append(body_jsonpath(s))
-                    elif body_pattern == '!jsonpath':
-                        matchers.append(is_not(body_jsonpath(s)))
-
-        elif k == 'method':
-            matchers.append(has_method(v))
-        elif k == 'urlPath':
-            matchers.append(has_path(v))
-        elif k == 'urlPattern':
-            matchers.append(has_url_pattern(v))
-        elif k == 'queryArgs':
-            matchers.append(has_query_args(v))
-        elif k == '!method':
-            matchers.append(is_not(has_method(v)))
-        elif k == '!urlPath':
-            matchers.append(is_not(has_path(v)))
-        elif k == '!queryArgs':
-            matchers.append(is_not(has_query_args(v)))
-        elif k == '!urlPattern':
-            matchers.append(is_not(has_url_pattern(v)))
-        elif k == 'headers':
-            matchers.append(has_headers(v))
-        elif k == '!headers':
-            matchers.append(is_not(has_headers(v)))
-    return matchers
-
-
 def match(request, session, trace, system_date, url_args, hooks,
           module_system_date=None):
     """Returns the stats of a request match process
@@ -97,50 +45,151 @@ def match(request, session, trace, system_date, url_args, hooks,
                                  title="no stubs found in session {0} for {1}, status={2}".format(
                                      session_name, scenario_key, session.get('status')))
 
+    compiled_session = get_compiled_session(session)
+    unmatched = compiled_session.unmatched
+    if unmatched is not None:
+        # the headers are not part of the request id but can be matched on
+        unmatched_key = request.id(), request.headers
+        if unmatched.get(unmatched_key):
+            trace.warn('request did not match any stub when last seen')
+            return (False,)
     stub_count = len(session['stubs'])
-    trace.info(u'matching against {0} stubs'.format(stub_count))
-    for stub_number in range(stub_count):
+    body_is_text = isinstance(request_text, basestring)
+    skip_static = getattr(hooks, 'skip_static', False)
+    found = None
+    if skip_static and compiled_session.exact_index and body_is_text:
+        # one pass over the body for the patterns of all stubs
+        found = compiled_session.search_contains(request)
+    if skip_static:
+        candidates = compiled_session.candidates(request, found)
+    else:
+        # the matcher stage transform may change the method and path of any
+        # stub
+        candidates = range(stub_count)
+    trace.info(u'matching against {0} of {1} stubs'.format(len(candidates),
+                                                           stub_count))
+    # True while the outcome depends only on the request, never for hooks
+    # that transform static stubs
+    static = skip_static
+    for stub_number in candidates:
         trace.info('stub ({0})'.format(stub_number))
+        compiled_stub = compiled_session.stubs[stub_number]
+        if skip_static and compiled_stub.contains_ids is not None and \
+                body_is_text:
+            # only static stubs have contains ids, other hooks may change
+            # their patterns in the transform
+            if found is None:
+                # one pass over the body for the patterns of all stubs
+                found = compiled_session.search_contains(request)
+            if not compiled_stub.contains_match(found):
+                trace.warn('request body does not satisfy the contains '
+                           'patterns of stub ({0})'.format(stub_number))
+                continue
         stub = StubCache(session['stubs'][stub_number], scenario_key,
                          session_name)
-        source_stub = copy.deepcopy(stub)
-        request_copy = copy.deepcopy(request)
-        stub, request_copy = transform(stub,
-                                       request_copy,
-                                       module_system_date=module_system_date,
-                                       system_date=system_date,
-                                       function='get/response',
-                                       cache=session.get('ext_cache'),
-                                       hooks=hooks,
-                                       stage='matcher',
-                                       trace=trace,
-                                       url_args=url_args)
-        trace.info('finished transformation')
-        if source_stub != stub:
-            trace.diff('stub ({0}) was transformed'.format(stub_number),
-                       source_stub.payload, stub.payload)
-            trace.info('stub ({0}) was transformed into'.format(stub_number),
-                       stub.payload)
-        if request_copy != request:
-            trace.diff('request was transformed', request_copy.request_body(),
-                       request.request_body())
-            trace.info('request was transformed into', request_copy.request_body())
+        source_stub = stub
+        if compiled_stub.static and skip_static:
+            # nothing to transform, use the stub and matchers as compiled
+            transformed = False
+            request_copy = request
+            matchers = compiled_stub.matchers
+        else:
+            static = False
+            transformed = True
+            stub, request_copy, matchers = _transform_stub(
+                compiled_stub, stub, request, trace, hooks,
+                module_system_date=module_system_date,
+                system_date=system_date,
+                cache=session.get('ext_cache'),
+                url_args=url_args)
+            if compiled_stub.error is not None and \
+                    matchers is compiled_stub.matchers:
+                # the stub failed to compile and the transform left it as is
+                raise compiled_stub.error
 
         matcher = StubMatcher(trace)
-        if matcher.match(request_copy, stub):
+        if matcher.match(request_copy, stub, matchers):
+            if not transformed:
+                # the request took the fast path
+                counters.incr('match.static_stub')
+            if stub is source_stub:
+                # the caller owns the returned stub
+                stub = stub.copy()
             return True, stub_number, stub
 
+    if static:
+        counters.incr('match.static_stub')
+        if unmatched is not None:
+            unmatched.set(unmatched_key, True)
     return (False,)
 
 
+def _transform_stub(compiled_stub, stub, request, trace, hooks, **kwargs):
+    """Run the matcher stage transform for a stub.
+
+    Returns the transformed stub and request and the compiled matchers, or
+    None if the matchers have to be rebuilt from the transformed stub.
+    """
+    stub_number = compiled_stub.number
+    source_stub = stub
+    # copy on write: only user exits (or transformers that are not
+    # copy_on_write) modify the stub and request in place
+    copied = compiled_stub.module or not getattr(hooks, 'copy_on_write',
+                                                 False)
+    if copied:
+        stub = copy.deepcopy(stub)
+        request_copy = copy.deepcopy(request)
+    else:
+        request_copy = request
+    stub, request_copy = transform(stub,
+                                   request_copy,
+                                   function='get/response',
+                                   hooks=hooks,
+                                   stage='matcher',
+                                   trace=trace,
+                                   **kwargs)
+    trace.info('finished transformation')
+    if copied:
+        stub_transformed = source_stub != stub
+        request_transformed = request_copy != request
+    else:
+        stub_transformed = stub is not source_stub
+        request_transformed = request_copy is not request
+    matchers = compiled_stub.matchers
+    if stub_transformed:
+        # matchers must be rebuilt from the transformed stub
+        matchers = None
+        if trace.full_tracking:
+            trace.diff('stub ({0}) was transformed'.format(stub_number),
+                       source_stub.payload, stub.payload)
+            trace.info('stub ({0}) was transformed into'.format(stub_number),
+                       stub.payload)
+    if request_transformed and trace.full_tracking:
+        trace.diff('request was transformed', request_copy.request_body(),
+                   request.request_body())
+        trace.info('request was transformed into', request_copy.request_body())
+    return stub, request_copy, matchers
+
+
 class StubMatcher(object):
     def __init__(self, trace):
         self.trace = trace
 
-    def match(self, request, stub):
-        """Match request with single stub"""
+    def match(self, request, stub, matchers=None):
+        """Match request with single stub
+
+        :param matchers: optional prebuilt matchers for the stub
+        """
+        if matchers is None:
+            matchers = build_matchers(stub)
+        if not (self.trace.full_tracking or log.isEnabledFor(logging.DEBUG)):
+            # nobody will see why the stub did not match
+            for matcher in matchers:
+                if not matcher.matches(request):
+                    return False
+            return True
         msg = StringDescription()
-        all = all_of(*build_matchers(stub))
+        all = all_of(*matchers)
         result = all.matches(request, msg)
         if not result:
             log.debug(u'No match found: {0}'.format(msg.out))
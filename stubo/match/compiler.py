@@ -0,0 +1,396 @@
+"""
+    stubo.match.compiler
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Compile the stubs of a playback session into matchers once and keep them
+    in a process local cache so get/response does not rebuild them for every
+    request.
+
+    :copyright: (c) 2015 by OpenCredo.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import threading
+import json
+import re
+
+from hamcrest import is_not
+
+from .request_matcher import (
+    body_contains, has_method, has_path, has_query_args, has_url_pattern,
+    body_xpath, body_jsonpath, has_headers
+)
+from .contains import ContainsIndex
+from stubo.model.stub import StubCache
+from stubo.utils import has_template_markup, compute_hash
+from stubo.utils.lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+def build_matchers(stub):
+    matchers = []
+    for k, v in stub.request().iteritems():
+        if k == 'bodyPatterns':
+            body_patterns = stub.request()['bodyPatterns']
+            for body_pattern, body_pattern_value in body_patterns.iteritems():
+                # bodyPatterns is a list
+                for s in body_pattern_value:
+                    if body_pattern == 'contains':
+                        matchers.append(body_contains(s))
+                    elif body_pattern == '!contains':
+                        matchers.append(is_not(body_contains(s)))
+                    elif body_pattern == 'xpath':
+                        namespaces = None
+                        if isinstance(s, tuple):
+                            s, namespaces = s
+                        matchers.append(body_xpath(s, namespaces))
+                    elif body_pattern == '!xpath':
+                        namespaces = None
+                        if isinstance(s, tuple):
+                            s, namespaces = s
+                        matchers.append(is_not(body_xpath(s, namespaces)))
+                    elif body_pattern == 'jsonpath':
+                        matchers.append(body_jsonpath(s))
+                    elif body_pattern == '!jsonpath':
+                        matchers.append(is_not(body_jsonpath(s)))
+
+        elif k == 'method':
+            matchers.append(has_method(v))
+        elif k == 'urlPath':
+            matchers.append(has_path(v))
+        elif k == 'urlPattern':
+            matchers.append(has_url_pattern(v))
+        elif k == 'queryArgs':
+            matchers.append(has_query_args(v))
+        elif k == '!method':
+            matchers.append(is_not(has_method(v)))
+        elif k == '!urlPath':
+            matchers.append(is_not(has_path(v)))
+        elif k == '!queryArgs':
+            matchers.append(is_not(has_query_args(v)))
+        elif k == '!urlPattern':
+            matchers.append(is_not(has_url_pattern(v)))
+        elif k == 'headers':
+            matchers.append(has_headers(v))
+        elif k == '!headers':
+            matchers.append(is_not(has_headers(v)))
+    # all matchers must match, evaluate the cheap ones first
+    matchers.sort(key=matcher_cost)
+    return matchers
+
+
+def matcher_cost(matcher):
+    """Return the relative cost of evaluating a matcher or its negation."""
+    return getattr(getattr(matcher, 'matcher', matcher), 'cost', 0)
+
+
+_regex_special = frozenset('.^$*+?{}[]\\|()')
+_regex_quantifiers = frozenset('*+?{')
+
+
+def url_pattern_prefix(regex):
+    """Return the literal path prefix a urlPattern regex requires or None.
+
+    Only patterns anchored with '^' and without alternation or inline flags
+    have a prefix as :class:`~stubo.match.request_matcher.UrlPattern` searches
+    anywhere in the path.
+    """
+    if not regex.startswith('^') or '|' in regex or '(?' in regex:
+        return None
+    prefix = []
+    i = 1
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            escaped = regex[i + 1:i + 2]
+            if not escaped or escaped.isalnum() or escaped == '_':
+                # character class or back reference
+                break
+            prefix.append(escaped)
+            i += 2
+        elif c in _regex_special:
+            if c in _regex_quantifiers and prefix:
+                # the last literal is optional or repeated
+                prefix.pop()
+            break
+        else:
+            prefix.append(c)
+            i += 1
+    return u''.join(prefix) or None
+
+
+class CompiledStub(object):
+    """The matchers of a single session stub, built once.
+
+    A stub is static if it has no user exit module and none of its contains
+    matchers are templates, the matcher stage transform leaves it unchanged.
+    A static stub with a single contains pattern, typically the whole recorded
+    request body, is exact and has its pattern id in ``exact_id``.
+
+    A stub whose matchers fail to compile, an invalid urlPattern regex or
+    json path say, keeps the exception in ``error`` for the match to raise
+    when it reaches the stub, the other stubs of the session still match.
+    """
+
+    __slots__ = ('number', 'matchers', 'module', 'static', 'method', 'path',
+                 'url_pattern', 'path_prefix', 'contains_ids',
+                 'not_contains_ids', 'exact_id', 'error')
+
+    def __init__(self, number, stub, contains_index):
+        self.number = number
+        self.module = bool(stub.payload.get('module'))
+        self.static = False
+        self.method = self.path = self.url_pattern = self.path_prefix = None
+        self.contains_ids = self.not_contains_ids = self.exact_id = None
+        self.error = None
+        if 'request' in stub.payload:
+            try:
+                self.matchers = tuple(build_matchers(stub))
+            except Exception, err:
+                log.warn('stub ({0}) matchers failed to compile: {1}'.format(
+                    number, err))
+                self.matchers = ()
+                self.error = err
+                return
+            if not self.module:
+                # user exits may change the stub, only index plain stubs
+                request = stub.request()
+                self.method = request.get('method')
+                self.path = request.get('urlPath')
+                if not self.path and request.get('urlPattern'):
+                    self.url_pattern = request['urlPattern']
+                    self.path_prefix = url_pattern_prefix(self.url_pattern)
+                self.static = not any(has_template_markup(x) for x in
+                                      stub.contains_matchers() or [])
+                if self.static:
+                    # templated matchers are only known after the transform
+                    self._index_contains(request, contains_index)
+        else:
+            # invalid stub, left to fail in the transform stage
+            self.matchers = ()
+
+    def _index_contains(self, request, contains_index):
+        body_patterns = request.get('bodyPatterns') or {}
+        contains = body_patterns.get('contains') or []
+        not_contains = body_patterns.get('!contains') or []
+        if contains or not_contains:
+            self.contains_ids = tuple(contains_index.add(x) for x in contains)
+            self.not_contains_ids = tuple(contains_index.add(x) for x in
+                                          not_contains)
+            if len(contains) == 1 and not not_contains and \
+                    not self.url_pattern:
+                self.exact_id = self.contains_ids[0]
+
+    def contains_match(self, found):
+        """Are the 'contains' patterns of this stub satisfied by the pattern
+        ids found in the request body?"""
+        return all(x in found for x in self.contains_ids) and \
+            not any(x in found for x in self.not_contains_ids)
+
+
+class CompiledSession(object):
+    """The compiled stubs of a playback session.
+
+    :Params:
+      - `session`: cached session payload, see :meth:`stubo.cache.Cache.create_session_cache`
+
+    Requests found not to match any stub are remembered in ``unmatched`` for
+    ``unmatched_cache_ttl`` seconds. As the compiled session is replaced when
+    the session is begun again, so are they. ``unmatched`` is None if the
+    size or the ttl is 0 or less.
+
+    Exact stubs are not scanned with the others. For hooks that skip static
+    stubs they are candidates when their pattern is found in the request
+    body, and a body equal to the
+    pattern of an exact stub is looked up in a hash map which keeps the
+    patterns found in it, so that body is only searched once.
+    """
+
+    unmatched_cache_size = 1000
+    unmatched_cache_ttl = 60
+
+    def __init__(self, session):
+        self.scenario_key = session['scenario']
+        self.session_name = session['session']
+        self.version = session.get('version')
+        # identifies the stubs of a session without a version
+        self.stubs_hash = None
+        self.unmatched = None
+        if self.unmatched_cache_size > 0 and self.unmatched_cache_ttl > 0:
+            self.unmatched = LRUCache(self.unmatched_cache_size,
+                                      'match.unmatched',
+                                      ttl=self.unmatched_cache_ttl)
+        self.contains_index = ContainsIndex()
+        self.stubs = tuple(CompiledStub(i, StubCache(payload,
+                                                     self.scenario_key,
+                                                     self.session_name),
+                                        self.contains_index)
+                           for i, payload in enumerate(session['stubs']))
+        self.contains_index.compile()
+        self._build_index()
+
+    def __len__(self):
+        return len(self.stubs)
+
+    def _build_index(self):
+        # (method, path) -> stub numbers, None stands for any method or path
+        self.route_index = {}
+        # exact pattern id -> [(method, path, stub number)]
+        self.exact_index = {}
+        # normalised exact pattern -> [found pattern ids or None until the
+        # pattern is first received as a request body]
+        self.exact_bodies = {}
+        # the distinct urlPattern regexes of the session
+        self.url_patterns = []
+        pattern_ids = {}
+        # trie of the literal prefixes of anchored urlPatterns, a node is
+        # [{char: node}, [(method, pattern id, stub number)]]
+        self.prefix_trie = [{}, []]
+        # [(method, pattern id, stub number)] for the other urlPatterns
+        self.unanchored_patterns = []
+        for stub in self.stubs:
+            if stub.error is not None:
+                # a candidate for every request, fails when reached
+                self.route_index.setdefault((None, None), []).append(
+                    stub.number)
+                continue
+            if stub.exact_id is not None:
+                self.exact_index.setdefault(stub.exact_id, []).append(
+                    (stub.method, stub.path, stub.number))
+                self.exact_bodies.setdefault(
+                    self.contains_index.patterns[stub.exact_id], [None])
+                continue
+            if not stub.url_pattern:
+                self.route_index.setdefault((stub.method, stub.path),
+                                            []).append(stub.number)
+                continue
+            pattern_id = pattern_ids.get(stub.url_pattern)
+            if pattern_id is None:
+                pattern_id = pattern_ids[stub.url_pattern] = \
+                    len(self.url_patterns)
+                self.url_patterns.append(re.compile(stub.url_pattern))
+            entry = stub.method, pattern_id, stub.number
+            if stub.path_prefix:
+                node = self.prefix_trie
+                for char in stub.path_prefix:
+                    node = node[0].setdefault(char, [{}, []])
+                node[1].append(entry)
+            else:
+                self.unanchored_patterns.append(entry)
+
+    def _pattern_entries(self, path):
+        # the urlPattern stubs whose literal prefix, if any, starts path
+        entries = list(self.unanchored_patterns)
+        node = self.prefix_trie
+        for char in path:
+            node = node[0].get(char)
+            if node is None:
+                break
+            entries.extend(node[1])
+        return entries
+
+    def candidates(self, request, found=None):
+        """Return the numbers of the stubs that could match the request
+        method and path, in session order. Only for hooks that skip static
+        stubs, other hooks may change any stub in the transform.
+
+        Each distinct urlPattern is evaluated at most once against the path.
+
+        :param found: optional result of :meth:`search_contains` for the request
+        """
+        method, path = request.method, request.path
+        keys = set([(None, None), (method, None)])
+        if path is not None:
+            keys.update([(None, path), (method, path)])
+        numbers = []
+        for key in keys:
+            numbers.extend(self.route_index.get(key, ()))
+        if isinstance(path, basestring):
+            matched = {}
+            for stub_method, pattern_id, number in \
+                    self._pattern_entries(path):
+                if stub_method not in (None, method):
+                    continue
+                is_match = matched.get(pattern_id)
+                if is_match is None:
+                    is_match = matched[pattern_id] = bool(
+                        self.url_patterns[pattern_id].search(path))
+                if is_match:
+                    numbers.append(number)
+        if self.exact_index:
+            numbers.extend(self._exact_candidates(request, found))
+        numbers.sort()
+        return numbers
+
+    def _exact_candidates(self, request, found):
+        method, path = request.method, request.path
+        if not isinstance(request.request_body(), basestring):
+            # left to the matchers to reject
+            pattern_ids = self.exact_index.keys()
+        else:
+            if found is None:
+                found = self.search_contains(request)
+            if isinstance(found, set):
+                pattern_ids = [x for x in found if x in self.exact_index]
+            else:
+                pattern_ids = [x for x in self.exact_index if x in found]
+        return [number for pattern_id in pattern_ids
+                for stub_method, stub_path, number in
+                self.exact_index[pattern_id]
+                if stub_method in (None, method) and
+                stub_path in (None, path)]
+
+    def search_contains(self, request):
+        """Return the ids of the session 'contains' patterns found in the
+        request body."""
+        text = request.request_body_normalised()
+        exact_body = self.exact_bodies.get(text)
+        if exact_body is None:
+            return self.contains_index.search(text)
+        if exact_body[0] is None:
+            exact_body[0] = self.contains_index.search(text)
+        return exact_body[0]
+
+
+_compiled_sessions = {}
+_compiled_sessions_lock = threading.Lock()
+
+
+def get_compiled_session(session):
+    """Return the :class:`CompiledSession` for a playback session payload.
+
+    Compiled sessions are cached per process keyed on scenario and session
+    and are recompiled when the session version changes. Sessions without a
+    version, begun before versions were stamped, are recompiled when the
+    hash of their stubs changes.
+    """
+    version = session.get('version')
+    stubs_hash = None if version else compute_hash(json.dumps(
+        session['stubs'], sort_keys=True, separators=(',', ':')))
+    key = (session['scenario'], session['session'])
+    compiled = _compiled_sessions.get(key)
+    if compiled is None or compiled.version != version or \
+            compiled.stubs_hash != stubs_hash:
+        compiled = CompiledSession(session)
+        compiled.stubs_hash = stubs_hash
+        log.debug('compiled {0} stubs for {1}, version={2}'.format(
+            len(compiled), key, version or stubs_hash))
+        with _compiled_sessions_lock:
+            _compiled_sessions[key] = compiled
+    return compiled
+
+
+def invalidate_compiled_session(scenario_key, session_name=None,
+                                keep_version=None):
+    """Drop compiled session(s) for a scenario, all its sessions if
+    ``session_name`` is not supplied. A compiled session of ``keep_version``
+    is kept, it is the session being set."""
+    with _compiled_sessions_lock:
+        keys = [k for k, v in _compiled_sessions.iteritems()
+                if k[0] == scenario_key and
+                (session_name is None or k[1] == session_name) and
+                (keep_version is None or v.version != keep_version)]
+        for key in keys:
+            del _compiled_sessions[key]
+    return len(keys)
@@ -0,0 +1,130 @@
+"""
+    stubo.match.contains
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Evaluate the bodyPatterns 'contains' strings of a whole session against a
+    request body at once.
+
+    :copyright: (c) 2015 by OpenCredo.
+    :license: GPLv3, see LICENSE for more details.
+"""
+
+
+def normalise(text):
+    """Remove all whitespace, as :class:`~stubo.match.request_matcher.BodyContains`
+    ignores it on both sides."""
+    return u''.join(text.split())
+
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton reporting which of a set of strings occur in
+    a text in a single pass over it."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] += (pattern_id,)
+        self._build_fail()
+
+    def _build_fail(self):
+        goto, fail, output = self.goto, self.fail, self.output
+        level = goto[0].values()
+        while level:
+            next_level = []
+            for state in level:
+                for char, next_state in goto[state].iteritems():
+                    f = fail[state]
+                    while f and char not in goto[f]:
+                        f = fail[f]
+                    f = goto[f].get(char, 0)
+                    fail[next_state] = f if f != next_state else 0
+                    output[next_state] += output[fail[next_state]]
+                    next_level.append(next_state)
+            level = next_level
+
+    def search(self, text):
+        """Return the set of pattern ids found in text"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while True:
+                next_state = goto[state].get(char)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class LazyFound(object):
+    """Pattern lookups against a text, each pattern is searched for once."""
+
+    def __init__(self, patterns, text):
+        self.patterns = patterns
+        self.text = text
+        self.found = {}
+
+    def __contains__(self, pattern_id):
+        found = self.found.get(pattern_id)
+        if found is None:
+            found = self.found[pattern_id] = \
+                self.text.find(self.patterns[pattern_id]) >= 0
+        return found
+
+
+class ContainsIndex(object):
+    """The unique normalised 'contains' and '!contains' strings of a session.
+
+    Sessions with at least ``automaton_threshold`` strings are searched with
+    an :class:`AhoCorasick` automaton, smaller ones with a memoised ``find``
+    per string which is quicker than a pure python pass over the body.
+    """
+
+    automaton_threshold = 500
+
+    def __init__(self):
+        self.patterns = []
+        self.ids = {}
+        self.automaton = None
+
+    def add(self, pattern):
+        """Add a pattern and return its id"""
+        pattern = normalise(pattern)
+        pattern_id = self.ids.get(pattern)
+        if pattern_id is None:
+            pattern_id = self.ids[pattern] = len(self.patterns)
+            self.patterns.append(pattern)
+        return pattern_id
+
+    def compile(self):
+        if len(self.patterns) >= self.automaton_threshold:
+            self.automaton = AhoCorasick(self.patterns)
+
+    def search(self, text):
+        """Return the ids of the patterns found in the normalised text, as a
+        container."""
+        if self.automaton:
+            found = self.automaton.search(text)
+            # the empty string is always contained
+            empty_id = self.ids.get(u'')
+            if empty_id is not None:
+                found.add(empty_id)
+            return found
+        return LazyFound(self.patterns, text)
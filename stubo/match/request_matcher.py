@@ -1,15 +1,16 @@
 import re
-import json
 
 from hamcrest.core.base_matcher import BaseMatcher
 from hamcrest.core.helpers.hasmethod import hasmethod
-from jsonpath_rw import parse
-
-from six.moves.urllib import parse as urlparse
-from stubo.ext import parse_xml
+from stubo.ext import compile_xpath, compile_jsonpath
+from stubo.utils import literal_dict
 
 
 class RequestMatcher(BaseMatcher):
+    #: relative cost of evaluating the matcher, cheaper matchers are
+    #: evaluated first, see :func:`~stubo.match.compiler.build_matchers`
+    cost = 0
+
     def __init__(self, expected, component_name):
         self.expected = expected
         self.component_name = component_name
@@ -41,15 +42,18 @@ def has_path(path):
 
 
 class UrlArgs(RequestMatcher):
+    cost = 2
+
     def __init__(self, expected, exact_match=False):
         super(UrlArgs, self).__init__(expected, 'query')
         self.exact_match = exact_match
+        self.expected_items = tuple(expected.iteritems())
 
     def _matches(self, request):
-        args = urlparse.parse_qs(self._get_value(request))
+        args = request.query_args()
         if self.exact_match:
             return args == self.expected
-        return all(item in args.items() for item in self.expected.items())
+        return all(k in args and args[k] == v for k, v in self.expected_items)
 
 
 def has_query_args(query_args, exact_match=False):
@@ -61,23 +65,35 @@ def has_exactly_query_args(query_args):
 
 
 class DictMatcher(RequestMatcher):
+    cost = 3
+
     def __init__(self, expected, attr, exact_match=False):
         if not isinstance(expected, dict):
-            expected = dict(eval(expected))
+            expected = literal_dict(expected)
         super(DictMatcher, self).__init__(expected, attr)
         self.exact_match = exact_match
+        self.expected_items = tuple(expected.iteritems())
 
     def _matches(self, request):
         headers = self._get_value(request)
         if not isinstance(headers, dict):
-            headers = dict(eval(headers))
+            headers = literal_dict(headers)
         if self.exact_match:
             return headers == self.expected
-        return all(headers.get(k) == v for k, v in self.expected.items())
+        return all(headers.get(k) == v for k, v in self.expected_items)
+
+
+class HeadersMatcher(DictMatcher):
+    def __init__(self, expected, exact_match=False):
+        super(HeadersMatcher, self).__init__(expected, 'headers',
+                                             exact_match=exact_match)
+
+    def _get_value(self, request):
+        return request.headers_dict()
 
 
 def has_headers(query_args, exact_match=False):
-    return DictMatcher(query_args, 'headers', exact_match=exact_match)
+    return HeadersMatcher(query_args, exact_match=exact_match)
 
 
 def has_exactly_headers(query_args):
@@ -85,12 +101,18 @@ def has_exactly_headers(query_args):
 
 
 class BodyContains(RequestMatcher):
+    cost = 4
+
     def __init__(self, expected):
         super(BodyContains, self).__init__(expected, "body_unicode")
+        self.normalised = u''.join(expected.split()).strip()
 
     def _matches(self, request):
         request_body = self._get_value(request)
-        if not isinstance(request_body, basestring) and not hasmethod(request_body, 'find'):
+        if isinstance(request_body, basestring):
+            # whitespace is stripped once per request
+            return request.request_body_normalised().find(self.normalised) >= 0
+        if not hasmethod(request_body, 'find'):
             return False
         return self._contains(self.expected, request_body)
 
@@ -129,6 +151,8 @@ def body_contains(substring):
 class UrlPattern(RequestMatcher):
     """URL pattern matcher for regular expressions"""
 
+    cost = 1
+
     def __init__(self, regex):
         super(UrlPattern, self).__init__(regex, "path")
         self.regex = re.compile(regex)
@@ -169,19 +193,20 @@ def has_url_pattern(regex):
 class BodyXPath(RequestMatcher):
     """XPath matcher for request body"""
 
+    cost = 6
+
     def __init__(self, xpath, namespaces=None):
         super(BodyXPath, self).__init__(xpath, "body_unicode")
         self.namespaces = namespaces or {}
 
     def _matches(self, request):
-        xml = self._get_value(request)
         try:
-            doc = parse_xml(xml)
+            doc = request.request_body_xml()
         except Exception, err:
             self.error = err
             return False
 
-        found = doc.xpath(self.expected, namespaces=self.namespaces)
+        found = compile_xpath(self.expected, self.namespaces)(doc)
         return True if found else False
 
     def describe_to(self, description):
@@ -215,13 +240,15 @@ def body_xpath(xpath, namespaces=None):
 class BodyJSONPath(RequestMatcher):
     """JSON Path matcher for request body"""
 
+    cost = 5
+
     def __init__(self, expr):
         super(BodyJSONPath, self).__init__(expr, "body_unicode")
-        self.jsonpath_expr = parse(expr)
+        self.jsonpath_expr = compile_jsonpath(expr)
 
     def _matches(self, request):
         try:
-            payload = json.loads(self._get_value(request))
+            payload = request.request_body_json()
             found = self.jsonpath_expr.find(payload)
             return True if found else False
         except Exception, err:
@@ -0,0 +1,378 @@
+import unittest
+import mock
+from stubo.testing import make_cache_stub
+
+
+class TestCompiledSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.session = {
+            "session": "compiled_1",
+            "scenario": "localhost:compiled",
+            "status": "playback",
+            "system_date": "2013-09-05",
+            "version": "1",
+            "stubs": [
+                make_cache_stub(["get my stub"], [1]),
+                make_cache_stub(["one two three"], [2]),
+            ]
+        }
+
+    def tearDown(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        invalidate_compiled_session('localhost:compiled')
+
+    def _get(self, session):
+        from stubo.match.compiler import get_compiled_session
+        return get_compiled_session(session)
+
+    def test_compile(self):
+        compiled = self._get(self.session)
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual([x.number for x in compiled.stubs], [0, 1])
+        self.assertEqual(len(compiled.stubs[0].matchers), 2)
+
+    def test_reuse_same_version(self):
+        compiled = self._get(self.session)
+        self.assertTrue(compiled is self._get(dict(self.session)))
+
+    def test_recompile_new_version(self):
+        compiled = self._get(self.session)
+        session = dict(self.session, version="2",
+                       stubs=[make_cache_stub(["other"], [3])])
+        recompiled = self._get(session)
+        self.assertFalse(compiled is recompiled)
+        self.assertEqual(len(recompiled), 1)
+
+    def test_no_version_cached_per_stubs(self):
+        self.session.pop('version')
+        compiled = self._get(self.session)
+        self.assertTrue(compiled is self._get(dict(self.session)))
+        session = dict(self.session, stubs=[make_cache_stub(["other"], [3])])
+        recompiled = self._get(session)
+        self.assertFalse(compiled is recompiled)
+        self.assertEqual(len(recompiled), 1)
+
+    def test_invalidate(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        compiled = self._get(self.session)
+        self.assertEqual(invalidate_compiled_session('localhost:compiled',
+                                                     'compiled_1'), 1)
+        self.assertFalse(compiled is self._get(self.session))
+
+    def test_invalidate_keeps_version(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        compiled = self._get(self.session)
+        self.assertEqual(invalidate_compiled_session(
+            'localhost:compiled', 'compiled_1', keep_version='1'), 0)
+        self.assertTrue(compiled is self._get(self.session))
+        self.assertEqual(invalidate_compiled_session(
+            'localhost:compiled', 'compiled_1', keep_version='2'), 1)
+
+    def test_invalidate_scenario(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        self._get(self.session)
+        self._get(dict(self.session, session='compiled_2'))
+        self.assertEqual(invalidate_compiled_session('localhost:compiled'), 2)
+
+    def test_match_uses_compiled_session(self):
+        from stubo.match import match
+        from stubo.utils.track import TrackTrace
+        from stubo.model.request import StuboRequest
+        from stubo.ext.transformer import StuboDefaultHooks
+        from stubo.testing import DummyModel
+        trace = TrackTrace(DummyModel(tracking_level='normal'), 'matcher')
+        request = StuboRequest(DummyModel(body='one two three', headers={}))
+        result = match(request, self.session, trace, None, {},
+                       StuboDefaultHooks())
+        self.assertTrue(result[0])
+        self.assertEqual(result[1], 1)
+        self.assertTrue(self._get(self.session) is self._get(self.session))
+
+
+class TestBuildMatchers(unittest.TestCase):
+
+    def test_cost_order(self):
+        from stubo.match.compiler import build_matchers
+        from stubo.match.request_matcher import (
+            RequestMatcher, UrlArgs, HeadersMatcher, BodyContains, BodyXPath,
+            BodyJSONPath
+        )
+        from stubo.model.stub import StubCache
+        request = dict(bodyPatterns={'xpath': ['/a'], 'jsonpath': ['$.a'],
+                                     '!contains': ['b'], 'contains': ['a']},
+                       method='POST', queryArgs={'a': ['1']},
+                       headers={'a': '1'})
+        stub = StubCache(dict(request=request,
+                              response=dict(status=200, ids=[1])),
+                         'localhost:build', 'build_1')
+        types = [type(getattr(x, 'matcher', x))
+                 for x in build_matchers(stub)]
+        self.assertEqual(types, [RequestMatcher, UrlArgs, HeadersMatcher,
+                                 BodyContains, BodyContains, BodyJSONPath,
+                                 BodyXPath])
+
+
+class TestUrlPatternPrefix(unittest.TestCase):
+
+    def _prefix(self, regex):
+        from stubo.match.compiler import url_pattern_prefix
+        return url_pattern_prefix(regex)
+
+    def test_anchored(self):
+        self.assertEqual(self._prefix('^/thing/matching/[0-9]+'),
+                         '/thing/matching/')
+
+    def test_not_anchored(self):
+        self.assertEqual(self._prefix('/thing/matching/[0-9]+'), None)
+
+    def test_escaped(self):
+        self.assertEqual(self._prefix(r'^/a\.b\d+'), '/a.b')
+
+    def test_quantifier_drops_last_literal(self):
+        self.assertEqual(self._prefix('^/items?/1'), '/item')
+
+    def test_alternation(self):
+        self.assertEqual(self._prefix('^/a|/b'), None)
+
+    def test_inline_flags(self):
+        self.assertEqual(self._prefix('^/a(?i)'), None)
+
+    def test_no_literal(self):
+        self.assertEqual(self._prefix('^.*'), None)
+
+
+class TestCandidates(unittest.TestCase):
+
+    def _request(self, method, path):
+        from stubo.model.request import StuboRequest
+        from stubo.testing import DummyModel
+        headers = {'Stubo-Request-Method': method}
+        if path:
+            headers['Stubo-Request-Path'] = path
+        return StuboRequest(DummyModel(body='', headers=headers))
+
+    def _compile(self, *requests):
+        from stubo.match.compiler import CompiledSession
+        stubs = [dict(request=x, response=dict(status=200, ids=[i]))
+                 for i, x in enumerate(requests)]
+        return CompiledSession(dict(scenario='localhost:routes',
+                                    session='routes_1', stubs=stubs))
+
+    def test_route_candidates_keep_order(self):
+        compiled = self._compile(dict(method='GET', urlPath='/a'),
+                                 dict(method='POST', urlPath='/a'),
+                                 dict(urlPath='/b'),
+                                 dict(method='GET'),
+                                 dict(method='GET', urlPattern='^/a/[0-9]+'),
+                                 dict(method='GET', urlPattern='[0-9]+'),
+                                 dict(method='GET', urlPath='/a'))
+        self.assertEqual(compiled.candidates(self._request('GET', '/a')),
+                         [0, 3, 6])
+        self.assertEqual(compiled.candidates(self._request('GET', '/a/1')),
+                         [3, 4, 5])
+        self.assertEqual(compiled.candidates(self._request('POST', '/b')),
+                         [2])
+        # patterns never match a request without a path
+        self.assertEqual(compiled.candidates(self._request('GET', None)),
+                         [3])
+
+    def test_url_pattern_evaluated_once(self):
+        compiled = self._compile(dict(urlPattern='^/a/[0-9]+'),
+                                 dict(urlPattern='^/a/[0-9]+'),
+                                 dict(urlPattern='^/a/[0-9]+$'),
+                                 dict(urlPattern='^/b/[0-9]+'),
+                                 dict(urlPattern='^/a/x'),
+                                 dict(urlPattern='^/a'))
+        compiled.url_patterns = [mock.Mock(wraps=x)
+                                 for x in compiled.url_patterns]
+        self.assertEqual(compiled.candidates(self._request('GET', '/a/12')),
+                         [0, 1, 2, 5])
+        self.assertEqual([x.search.call_count for x in
+                          compiled.url_patterns], [1, 1, 0, 0, 1])
+
+    def test_invalid_stub_always_candidate(self):
+        compiled = self._compile(dict(method='GET', urlPath='/a'),
+                                 dict(method='GET', urlPattern='^/a(['),
+                                 dict(bodyPatterns={'jsonpath': ['$..[']}))
+        self.assertEqual(compiled.stubs[0].error, None)
+        self.assertTrue(compiled.stubs[1].error)
+        self.assertTrue(compiled.stubs[2].error)
+        self.assertEqual(compiled.candidates(self._request('POST', '/b')),
+                         [1, 2])
+
+    def test_module_stub_always_candidate(self):
+        from stubo.match.compiler import CompiledSession
+        stubs = [dict(request=dict(method='GET', urlPath='/a'),
+                      response=dict(status=200, ids=[1]),
+                      module=dict(name='dummy', version=1))]
+        compiled = CompiledSession(dict(scenario='localhost:routes',
+                                        session='routes_1', stubs=stubs))
+        self.assertEqual(compiled.candidates(self._request('POST', '/b')),
+                         [0])
+
+
+class TestContainsPrecheck(unittest.TestCase):
+
+    def _match(self, body, stubs, threshold=None):
+        from stubo.match import match
+        from stubo.match.contains import ContainsIndex
+        from stubo.utils.track import TrackTrace
+        from stubo.model.request import StuboRequest
+        from stubo.ext.transformer import StuboDefaultHooks
+        from stubo.testing import DummyModel
+        session = dict(scenario='localhost:contains', session='contains_1',
+                       status='playback', stubs=stubs)
+        trace = TrackTrace(DummyModel(tracking_level='normal'), 'matcher')
+        request = StuboRequest(DummyModel(body=body, headers={}))
+        with mock.patch.object(ContainsIndex, 'automaton_threshold',
+                               threshold or ContainsIndex.automaton_threshold):
+            return match(request, session, trace, None, {},
+                         StuboDefaultHooks())
+
+    def _stubs(self):
+        stubs = [make_cache_stub(["one", "two"], [1]),
+                 make_cache_stub(["one"], [2]),
+                 make_cache_stub(["{{1+1}}"], [3]),
+                 make_cache_stub(["three"], [4])]
+        stubs[1]['request']['bodyPatterns']['!contains'] = ['three']
+        return stubs
+
+    def test_not_contains(self):
+        for threshold in (None, 1):
+            result = self._match('one three', self._stubs(), threshold)
+            self.assertEqual(result[1], 3)
+
+    def test_templated_matcher(self):
+        for threshold in (None, 1):
+            result = self._match('a 2 b', self._stubs(), threshold)
+            self.assertEqual(result[1], 2)
+
+    def test_compiled_ids(self):
+        from stubo.match.compiler import CompiledSession
+        compiled = CompiledSession(dict(scenario='localhost:contains',
+                                        session='contains_1',
+                                        stubs=self._stubs()))
+        self.assertEqual(compiled.stubs[0].contains_ids, (0, 1))
+        self.assertEqual(compiled.stubs[1].contains_ids, (0,))
+        self.assertEqual(compiled.stubs[1].not_contains_ids, (2,))
+        self.assertEqual(compiled.stubs[2].contains_ids, None)
+
+
+class TestUnmatchedCache(unittest.TestCase):
+
+    def _session(self, *matchers):
+        return dict(scenario='localhost:unmatched', session='unmatched_1',
+                    status='playback', version='1',
+                    stubs=[make_cache_stub([x], [i])
+                           for i, x in enumerate(matchers)])
+
+    def tearDown(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        invalidate_compiled_session('localhost:unmatched')
+
+    def _match(self, body, session):
+        from stubo.match import match
+        from stubo.utils.track import TrackTrace
+        from stubo.model.request import StuboRequest
+        from stubo.ext.transformer import StuboDefaultHooks
+        from stubo.testing import DummyModel
+        trace = TrackTrace(DummyModel(tracking_level='normal'), 'matcher')
+        request = StuboRequest(DummyModel(body=body, headers={}))
+        return match(request, session, trace, None, {}, StuboDefaultHooks())
+
+    def test_unmatched_request_not_matched_again(self):
+        from stubo.match.compiler import CompiledSession
+        session = self._session('one', 'two')
+        self.assertFalse(self._match('three', session)[0])
+        with mock.patch.object(CompiledSession, 'candidates') as candidates:
+            self.assertFalse(self._match('three', session)[0])
+        self.assertFalse(candidates.called)
+        self.assertTrue(self._match('two', session)[0])
+
+    def test_disabled(self):
+        from stubo.match.compiler import (
+            CompiledSession, invalidate_compiled_session
+        )
+        for name in ('unmatched_cache_size', 'unmatched_cache_ttl'):
+            invalidate_compiled_session('localhost:unmatched')
+            session = self._session('one', 'two')
+            with mock.patch.object(CompiledSession, name, 0):
+                self.assertFalse(self._match('three', session)[0])
+            with mock.patch.object(CompiledSession, 'candidates',
+                                   return_value=[]) as candidates:
+                self.assertFalse(self._match('three', session)[0])
+            self.assertTrue(candidates.called)
+
+    def test_templated_stubs_not_remembered(self):
+        from stubo.match.compiler import get_compiled_session
+        session = self._session('one', '{{1+1}}')
+        self.assertFalse(self._match('three', session)[0])
+        self.assertEqual(len(get_compiled_session(session).unmatched), 0)
+
+    def test_new_version_forgets(self):
+        from stubo.match.compiler import get_compiled_session
+        session = self._session('one')
+        self.assertFalse(self._match('three', session)[0])
+        session = dict(session, version='2')
+        self.assertEqual(len(get_compiled_session(session).unmatched), 0)
+
+
+class TestExactIndex(unittest.TestCase):
+
+    def _compile(self):
+        from stubo.match.compiler import CompiledSession
+        stubs = [make_cache_stub(["<a>1</a>"], [0]),
+                 make_cache_stub(["<a>2</a>", "2"], [1]),
+                 make_cache_stub(["<b><a>1</a></b>"], [2]),
+                 make_cache_stub(["<a>{{1+1}}</a>"], [3]),
+                 make_cache_stub(["<b> <a>2</a> </b>"], [4])]
+        stubs[4]['request']['method'] = 'GET'
+        return CompiledSession(dict(scenario='localhost:exact',
+                                    session='exact_1', stubs=stubs))
+
+    def _request(self, body, method='POST'):
+        from stubo.model.request import StuboRequest
+        from stubo.testing import DummyModel
+        return StuboRequest(DummyModel(body=body, headers={
+            'Stubo-Request-Method': method}))
+
+    def test_exact_stubs(self):
+        compiled = self._compile()
+        self.assertEqual([x.exact_id for x in compiled.stubs],
+                         [0, None, 3, None, 4])
+        self.assertEqual(sorted(compiled.exact_bodies),
+                         [u'<a>1</a>', u'<b><a>1</a></b>', u'<b><a>2</a></b>'])
+
+    def test_candidates(self):
+        compiled = self._compile()
+        self.assertEqual(compiled.candidates(self._request('<a>1</a>')),
+                         [0, 1, 3])
+        # the body contains a shorter exact pattern
+        self.assertEqual(compiled.candidates(self._request('<b><a>1</a></b>')),
+                         [0, 1, 2, 3])
+        self.assertEqual(compiled.candidates(self._request('<b><a>2</a></b>')),
+                         [1, 3])
+        self.assertEqual(compiled.candidates(self._request('<b><a>2</a></b>',
+                                                           'GET')),
+                         [4])
+
+    def test_candidates_with_url_pattern(self):
+        from stubo.match.compiler import CompiledSession
+        stubs = [make_cache_stub(["<a>1</a>"], [0]),
+                 make_cache_stub(["x", "y"], [1])]
+        stubs[1]['request']['urlPattern'] = '^/a'
+        compiled = CompiledSession(dict(scenario='localhost:exact',
+                                        session='exact_1', stubs=stubs))
+        request = self._request('<a>1</a>')
+        request.path = '/a/1'
+        self.assertEqual(compiled.candidates(request), [0, 1])
+
+    def test_exact_body_searched_once(self):
+        compiled = self._compile()
+        with mock.patch.object(compiled.contains_index, 'search',
+                               wraps=compiled.contains_index.search) as search:
+            for _ in range(2):
+                compiled.search_contains(self._request('<a>1</a>'))
+                compiled.search_contains(self._request('<a>3</a>'))
+        self.assertEqual(search.call_count, 3)
@@ -0,0 +1,56 @@
+import unittest
+
+
+class TestAhoCorasick(unittest.TestCase):
+
+    def _search(self, patterns, text):
+        from stubo.match.contains import AhoCorasick
+        return AhoCorasick(patterns).search(text)
+
+    def test_found(self):
+        self.assertEqual(self._search([u'he', u'she', u'his', u'hers'],
+                                      u'ushers'), set([0, 1, 3]))
+
+    def test_not_found(self):
+        self.assertEqual(self._search([u'abc', u'xyz'], u'abxyabc'),
+                         set([0]))
+
+    def test_suffix_via_fail_links(self):
+        self.assertEqual(self._search([u'aab', u'ab', u'b'], u'aaab'),
+                         set([0, 1, 2]))
+
+    def test_unicode(self):
+        self.assertEqual(self._search([u'caf\xe9', u'\u20ac'], u'un caf\xe9'),
+                         set([0]))
+
+
+class TestContainsIndex(unittest.TestCase):
+
+    def _make(self, threshold=None):
+        from stubo.match.contains import ContainsIndex
+        index = ContainsIndex()
+        if threshold is not None:
+            index.automaton_threshold = threshold
+        return index
+
+    def test_dedupe_normalised(self):
+        index = self._make()
+        self.assertEqual(index.add(u'get my stub'), 0)
+        self.assertEqual(index.add(u'get  my\n stub'), 0)
+        self.assertEqual(index.add(u'other'), 1)
+
+    def _check(self, index):
+        ids = [index.add(x) for x in (u'one two', u'three', u'', u'four')]
+        index.compile()
+        found = index.search(u'onetwothree')
+        self.assertEqual([x in found for x in ids], [True, True, True, False])
+
+    def test_find(self):
+        index = self._make()
+        self._check(index)
+        self.assertTrue(index.automaton is None)
+
+    def test_automaton(self):
+        index = self._make(threshold=1)
+        self._check(index)
+        self.assertTrue(index.automaton is not None)
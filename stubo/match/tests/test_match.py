@@ -95,6 +95,95 @@ class Test_body_contains_matching(unittest.TestCase):
         stub = results[2]                                             
         self.assertEquals(stub.response_ids(), [7])
         
+    def test_session_stubs_not_modified(self):
+        import copy
+        self.first_2_session['stubs'].insert(0, make_cache_stub(
+            ["{{1+1}} stub"], [0]))
+        stubs = copy.deepcopy(self.first_2_session['stubs'])
+        results = self._get_best_match("get my 2 stub", self.first_2_session)
+        self.assertTrue(results[0])
+        stub = results[2]
+        self.assertEquals(stub.contains_matchers(), [u"2 stub"])
+        self.assertEqual(self.first_2_session['stubs'], stubs)
+
+    def test_returned_stub_is_a_copy(self):
+        results = self._get_best_match("get my stub", self.first_2_session)
+        stub = results[2]
+        stub.set_response_body('changed')
+        self.assertFalse('body' in self.first_2_session['stubs'][0]['response'])
+
+    def test_no_deepcopy_for_plain_stubs(self):
+        import copy
+        from stubo.model.request import StuboRequest
+        from stubo.model.stub import StubCache
+        with mock.patch('copy.deepcopy', wraps=copy.deepcopy) as deepcopy:
+            results = self._get_best_match("one two three",
+                                           self.first_2_session)
+        self.assertTrue(results[0])
+        copied = [x[0][0] for x in deepcopy.call_args_list]
+        # only the payload of the winning stub is copied
+        self.assertFalse([x for x in copied if isinstance(x, (StuboRequest,
+                                                              StubCache))])
+
+    def test_static_stubs_not_transformed(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+        session = dict(self.first_2_session,
+                       stubs=[make_cache_stub(["{{1+1}} ways"], [1]),
+                              make_cache_stub(["one two three"], [2])])
+        with mock.patch('stubo.match.transform') as transform:
+            transform.side_effect = lambda stub, request, **kwargs: (stub,
+                                                                     request)
+            results = self._get_best_match("one two three", session)
+        self.assertEqual(results[1], 1)
+        # only the templated stub was transformed
+        self.assertEqual(transform.call_count, 1)
+        self.assertEqual(counters.get('match.static_stub'), 1)
+
+    def test_templated_match_not_counted(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+        session = dict(self.first_2_session,
+                       stubs=[make_cache_stub(["{{1+1}} ways"], [1])])
+        results = self._get_best_match("2 ways", session)
+        self.assertEqual(results[1], 0)
+        self.assertEqual(counters.get('match.static_stub'), 0)
+
+    def test_static_stub_counted_once_per_request(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+        stubs = [make_cache_stub(["one"], [1]), make_cache_stub(["one"], [2])]
+        stubs[0]['request']['headers'] = {'x': 'y'}
+        results = self._get_best_match("one two three",
+                                       dict(self.first_2_session, stubs=stubs))
+        self.assertEqual(results[1], 1)
+        self.assertEqual(counters.get('match.static_stub'), 1)
+
+    def test_invalid_stub_fails_when_reached(self):
+        stubs = [make_cache_stub(["body"], [1]), make_cache_stub(["body"], [2])]
+        stubs[1]['request']['urlPattern'] = '^/a(['
+        session = dict(self.first_2_session, stubs=stubs)
+        self.assertEqual(self._get_best_match("body", session)[:2], (True, 0))
+        import sre_constants
+        with self.assertRaises(sre_constants.error):
+            self._get_best_match("other", session)
+
+    def test_no_mismatch_description_unless_seen(self):
+        import stubo.match
+        with mock.patch.object(stubo.match.log, 'isEnabledFor',
+                               return_value=False), \
+                mock.patch('stubo.match.StringDescription') as description:
+            results = self._get_best_match("one two three",
+                                           self.first_2_session)
+        self.assertEqual(results[1], 4)
+        self.assertFalse(description.called)
+        with mock.patch.object(stubo.match.log, 'isEnabledFor',
+                               return_value=True), \
+                mock.patch('stubo.match.StringDescription',
+                           wraps=stubo.match.StringDescription) as description:
+            self._get_best_match("one two three", self.first_2_session)
+        self.assertTrue(description.called)
+
     def test_matcher_with_no_stubs_and_not_playback_session_fails(self):
         from stubo.exceptions import HTTPClientError
         session = {              
@@ -117,6 +206,70 @@ class Test_body_contains_matching(unittest.TestCase):
         with self.assertRaises(HTTPServerError): 
             self._get_best_match("", session)           
 
+class TestCustomHooks(unittest.TestCase):
+    """Hooks that do not skip static stubs may change any stub in the
+    matcher stage transform."""
+
+    def tearDown(self):
+        from stubo.match.compiler import invalidate_compiled_session
+        invalidate_compiled_session('localhost:custom')
+
+    def _match(self, stubs, body, change, path=None):
+        from stubo.match import match
+        from stubo.utils.track import TrackTrace
+        from stubo.model.request import StuboRequest
+        from stubo.ext.hooks import Hooks
+        from stubo.ext.transformer import TransformerBase
+
+        class CustomTransformer(TransformerBase):
+            def transform(self, request, **kwargs):
+                change(self.stub)
+                return self.stub, request
+
+        class CustomHooks(Hooks):
+            def make_transformer(self, stub):
+                return CustomTransformer(stub)
+
+        session = dict(scenario='localhost:custom', session='custom_1',
+                       status='playback', stubs=stubs)
+        headers = {'Stubo-Request-Method': 'POST'}
+        if path:
+            headers['Stubo-Request-Path'] = path
+        trace = TrackTrace(DummyModel(tracking_level='normal'), 'matcher')
+        request = StuboRequest(DummyModel(body=body, headers=headers))
+        return match(request, session, trace, None, {}, CustomHooks())[:2]
+
+    def test_path_changed_by_transform(self):
+        stub = make_cache_stub(["hello"], [1])
+        stub['request']['urlPath'] = '/recorded'
+
+        def change(stub):
+            stub.request()['urlPath'] = '/moved'
+
+        self.assertEqual(self._match([stub], 'hello', change, path='/moved'),
+                         (True, 0))
+
+    def _upper(self, stub):
+        stub.set_contains_matchers([x.upper() for x in
+                                    stub.contains_matchers()])
+
+    def test_exact_pattern_changed_by_transform(self):
+        stubs = [make_cache_stub(["hello"], [1])]
+        self.assertEqual(self._match(stubs, 'HELLO', self._upper), (True, 0))
+
+    def test_miss_not_remembered(self):
+        stubs = [make_cache_stub(["hello", "world"], [1])]
+        self.assertEqual(self._match(stubs, 'HELLO WORLD', lambda stub: None),
+                         (False,))
+        self.assertEqual(self._match(stubs, 'HELLO WORLD', self._upper),
+                         (True, 0))
+
+    def test_contains_changed_by_transform(self):
+        stubs = [make_cache_stub(["hello", "world"], [1])]
+        self.assertEqual(self._match(stubs, 'HELLO WORLD', self._upper),
+                         (True, 0))
+
+
 class TestMatcherWithModule(unittest.TestCase):
     
     def setUp(self):
@@ -167,6 +320,29 @@ class TestMatcherWithModule(unittest.TestCase):
         else:
             assert False    
 
+    def test_exit_request_changes_not_shared(self):
+        from stubo.match import match
+        from stubo.utils.track import TrackTrace
+        from stubo.model.request import StuboRequest
+        from stubo.ext.transformer import StuboDefaultHooks
+        from stubo.ext.module import Module
+        Module('localhost').add('query', query_exit_code)
+        stubs = [make_cache_stub(["body"], [1]), make_cache_stub(["body"], [2])]
+        stubs[0]['module'] = dict(name='query', version=1,
+                                  system_date='2013-08-07')
+        stubs[0]['request']['queryArgs'] = {'q': ['3']}
+        stubs[1]['request']['queryArgs'] = {'q': ['1']}
+        session = dict(session='query_1', scenario='localhost:query',
+                       status='playback', stubs=stubs)
+        trace = TrackTrace(DummyModel(tracking_level='normal'), 'matcher')
+        request = StuboRequest(DummyModel(body='body', headers={
+            'Stubo-Request-Query': 'q=2'}))
+        try:
+            self.assertEqual(match(request, session, trace, None, {},
+                                   StuboDefaultHooks()), (False,))
+        finally:
+            Module('localhost').remove('query')
+
                       
 exit_code = """
 from stubo.ext.user_exit import GetResponse, ExitResponse
@@ -184,6 +360,20 @@ def exits(request, context):
         return Dummy(request, context)
 """
 
+query_exit_code = """
+from stubo.ext.user_exit import GetResponse, ExitResponse
+
+class Query(GetResponse):
+
+    def doMatcherRequest(self):
+        self.request.query = 'q=1'
+        return ExitResponse(self.request, self.context['stub'])
+
+def exits(request, context):
+    if context['function'] == 'get/response':
+        return Query(request, context)
+"""
+
 class TestStubMatcher(unittest.TestCase):
     
     def _make(self):
@@ -1,8 +1,16 @@
-"""  
+"""
     :copyright: (c) 2015 by OpenCredo.
     :license: GPLv3, see LICENSE for more details.
 """
-from stubo.utils import get_unicode_from_request, compute_hash
+import copy
+import json
+import re
+
+from six.moves.urllib import parse as urlparse
+from tornado.escape import utf8
+from requests.utils import get_encoding_from_headers
+from stubo.utils import decode_body, compute_hash, literal_dict
+from stubo.ext import parse_xml
 
 
 class StuboRequest(object):
@@ -10,7 +18,7 @@ class StuboRequest(object):
 
     def __init__(self, request):
         """Create an instance using an HTTP request.
-        
+
          :Params:
           - `request`: an HTTP request. See :class:`~tornado.httpclient.HTTPRequest`
         """
@@ -21,11 +29,60 @@ class StuboRequest(object):
         self.path = request.headers.get('Stubo-Request-Path', None)
         self.query = request.headers.get('Stubo-Request-Query', '')
         self.body = request.body
-        self.body_unicode = get_unicode_from_request(request)
+        self.content_type = request.headers.get('Content-Type') or \
+            request.headers.get('content-type')
+        # decoded on first use, see body_unicode
+        self._body_unicode = None
+        self._body_replaced = False
+        # values derived from the body, computed on first use
+        self._parsed = {}
+
+    @property
+    def body_unicode(self):
+        if self._body_unicode is None:
+            self._body_unicode = decode_body(self.body, self.encoding())
+        return self._body_unicode
+
+    @body_unicode.setter
+    def body_unicode(self, body):
+        self._body_unicode = body
+        self._body_replaced = True
+        # a new dict, copies of the request may share the old one
+        self._parsed = {}
+
+    def encoding(self):
+        """ charset of the body from the content type if any
+        """
+        if not self.content_type:
+            return None
+        return get_encoding_from_headers({'content-type': self.content_type})
 
     def id(self):
-        return compute_hash(u"".join([self.request_body(), self.path or "",
-                                      self.method, self.query]))
+        return self._memoise('id', lambda: compute_hash("".join([
+            self._id_body(), utf8(self.path or ""), utf8(self.method),
+            utf8(self.query)])), source=(self.path, self.method, self.query))
+
+    def _id_body(self):
+        """ The body as utf-8 for the request id.
+
+        An ASCII body received in an ASCII compatible charset is the same as
+        the utf-8 encoding of its text so it is hashed without being decoded.
+        """
+        body = self.body
+        if isinstance(body, str) and not self._body_replaced and \
+                not _non_ascii.search(body) and \
+                _ascii_compatible(self.encoding()):
+            return body
+        return utf8(self.request_body())
+
+    def normalised_id(self):
+        """ id of the request with all whitespace removed from the body, the
+        same as id() for a body without whitespace
+        """
+        return self._memoise('normalised_id', lambda: compute_hash("".join([
+            utf8(self.request_body_normalised()), utf8(self.path or ""),
+            utf8(self.method), utf8(self.query)])),
+            source=(self.path, self.method, self.query))
 
     def request_body_unicode(self):
         """ Request body text converted into unicode
@@ -41,6 +98,65 @@ class StuboRequest(object):
     def set_request_body_unicode(self, body):
         self.body_unicode = body
 
+    def _memoise(self, name, parse, source=None):
+        """ Return parse() computed once, again if source, the attributes
+        other than the body the value is derived from, has changed since.
+        """
+        try:
+            parsed_source, result, error = self._parsed[name]
+            if parsed_source != source:
+                raise KeyError(name)
+        except KeyError:
+            result = error = None
+            try:
+                result = parse()
+            except Exception, e:
+                error = e
+            self._parsed[name] = source, result, error
+        if error is not None:
+            raise error
+        return result
+
+    def request_body_normalised(self):
+        """ Request body text with all whitespace removed
+        """
+        return self._memoise('normalised',
+                             lambda: u''.join(self.request_body().split()))
+
+    def request_body_xml(self):
+        """ Request body parsed as XML, raises if the body is not XML.
+
+        The document is shared by all users of the request, do not modify it.
+        """
+        return self._memoise('xml', lambda: parse_xml(self.request_body()))
+
+    def request_body_json(self):
+        """ Request body parsed as JSON, raises if the body is not JSON
+        """
+        return self._memoise('json', lambda: json.loads(self.request_body()))
+
+    def query_args(self):
+        """ Request query string parsed into a dict of lists
+        """
+        return self._memoise('query', lambda: urlparse.parse_qs(self.query),
+                             source=self.query)
+
+    def headers_dict(self):
+        """ Request headers parsed into a dict
+        """
+        return self._memoise('headers', lambda: literal_dict(self.headers),
+                             source=self.headers)
+
+    def __deepcopy__(self, memo):
+        # the copy starts with the values parsed so far, in a dict of its
+        # own as it may parse others after its attributes are changed
+        result = object.__new__(type(self))
+        memo[id(self)] = result
+        for k, v in self.__dict__.iteritems():
+            setattr(result, k, dict(v) if k == '_parsed' else
+                    copy.deepcopy(v, memo))
+        return result
+
     def __eq__(self, other):
         if type(other) is type(self):
             return self.request_body() == other.request_body()
@@ -55,3 +171,23 @@ class StuboRequest(object):
 
     def describe_to(self, desc):
         desc.append(str(self))
+
+
+_non_ascii = re.compile(r'[\x80-\xff]')
+
+
+def _ascii_compatible(encoding):
+    if encoding is None:
+        return True
+    try:
+        return _ascii_compatible_cache[encoding]
+    except KeyError:
+        try:
+            result = u'<a b="1"/>'.encode(encoding) == '<a b="1"/>'
+        except (LookupError, UnicodeError):
+            result = False
+        _ascii_compatible_cache[encoding] = result
+        return result
+
+
+_ascii_compatible_cache = {}
@@ -4,6 +4,7 @@
 """
 import logging
 import json
+import copy
 
 from stubo.model.stub_parser import (
     JSONStubParser, LegacyStubParser
@@ -61,6 +62,13 @@ class StubData(object):
     def set_response_body(self, body):
         self.response()['body'] = body
 
+    def response_templated(self):
+        # responses not classified by create_session_cache may be templates
+        return self.response().get('templated', True)
+
+    def set_response_templated(self, templated):
+        self.response()['templated'] = templated
+
     def response_body(self):
         # Note can be more than one response for stateful requests
         response = self.response().get('body')
@@ -124,6 +132,12 @@ class StubData(object):
     def set_module(self, module):
         self.payload['module'] = module
 
+    def copy(self):
+        """Return a copy of this stub with its own payload"""
+        stub = copy.copy(self)
+        stub.payload = copy.deepcopy(self.payload)
+        return stub
+
     def space_used(self):
         return len(unicode(self.payload))
 
@@ -203,14 +217,20 @@ class StubCache(StubData):
                                       self.request_query_args() or ""]))
 
     def load_from_cache(self, response_ids, delay_policy_name, recorded,
-                        system_date, module_info, request_index_key):
+                        system_date, module_info, request_index_key,
+                        response=None, delay_policy=None):
+        """Load the cached response and delay policy of a request, unless
+        they were already looked up with it."""
         self.payload = dict(response=dict(ids=response_ids))
-        response = self.get_response_from_cache(request_index_key)
+        if response is None:
+            response = self.get_response_from_cache(request_index_key)
         self.payload['response'] = response
         self.set_recorded(recorded)
         if module_info:
             self.set_module(module_info)
-        if delay_policy_name:
+        if delay_policy is not None:
+            self.set_delay_policy(delay_policy)
+        elif delay_policy_name:
             self.load_delay_from_cache(delay_policy_name)
 
     def get_response_from_cache(self, request_index_key):
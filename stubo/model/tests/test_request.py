@@ -0,0 +1,152 @@
+import unittest
+import mock
+
+
+class TestStuboRequest(unittest.TestCase):
+    def _make(self, body='', **headers):
+        from stubo.model.request import StuboRequest
+        from stubo.testing import DummyModel
+
+        return StuboRequest(DummyModel(body=body, headers=headers))
+
+    def test_normalised(self):
+        request = self._make(' <a>\n  hello  world</a> ')
+        self.assertEqual(request.request_body_normalised(),
+                         u'<a>helloworld</a>')
+
+    def test_xml_parsed_once(self):
+        request = self._make('<a><b>1</b></a>')
+        doc = request.request_body_xml()
+        self.assertEqual(doc.xpath('/a/b')[0].text, '1')
+        self.assertTrue(doc is request.request_body_xml())
+
+    def test_xml_error_raised_each_time(self):
+        request = self._make('not xml')
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                request.request_body_xml()
+
+    def test_json(self):
+        request = self._make('{"a": [1, 2]}')
+        self.assertEqual(request.request_body_json(), {'a': [1, 2]})
+        self.assertTrue(request.request_body_json() is
+                        request.request_body_json())
+
+    def test_query_and_headers(self):
+        request = self._make(**{'Stubo-Request-Query': 'a=1&a=2&b=3',
+                                'Stubo-Request-Headers': '{"X-A": "1"}'})
+        self.assertEqual(request.query_args(), {'a': ['1', '2'], 'b': ['3']})
+        self.assertEqual(request.headers_dict(), {'X-A': '1'})
+
+    def test_headers_not_evaluated(self):
+        request = self._make(**{'Stubo-Request-Headers':
+                                '__import__("os").getcwd()'})
+        with self.assertRaises(ValueError):
+            request.headers_dict()
+        request = self._make(**{'Stubo-Request-Headers': ' '})
+        self.assertEqual(request.headers_dict(), {})
+
+    def test_id_memoised(self):
+        request = self._make('<a/>')
+        with mock.patch('stubo.model.request.compute_hash',
+                        return_value='1') as compute_hash:
+            self.assertEqual(request.id(), '1')
+            self.assertEqual(request.id(), '1')
+            request.set_request_body_unicode(u'<b/>')
+            request.id()
+        self.assertEqual(compute_hash.call_count, 2)
+
+    def test_normalised_id(self):
+        request = self._make('<a>\n  <b>1</b>\n</a>')
+        self.assertEqual(request.normalised_id(),
+                         self._make('<a><b>1</b></a>').normalised_id())
+        self.assertEqual(self._make('<a/>').normalised_id(),
+                         self._make('<a/>').id())
+
+    def test_normalised_id_non_ascii_path(self):
+        headers = {'Stubo-Request-Path': '/caf\xc3\xa9',
+                   'Stubo-Request-Query': 'q=\xc3\xa9'}
+        request = self._make('<a>\xc3\xa9</a>', **headers)
+        self.assertEqual(request.normalised_id(), request.id())
+        self.assertNotEqual(request.normalised_id(),
+                            self._make('<a>\xc3\xa9</a>').normalised_id())
+
+    def test_set_body_resets(self):
+        request = self._make('<a>1</a>')
+        self.assertEqual(request.request_body_normalised(), u'<a>1</a>')
+        request.set_request_body_unicode(u'<b> 2 </b>')
+        self.assertEqual(request.request_body_normalised(), u'<b>2</b>')
+        self.assertEqual(request.request_body_xml().tag, 'b')
+
+    def test_assign_body_resets(self):
+        import copy
+
+        request = self._make('<a>1</a>')
+        request_id = request.id()
+        request.request_body_xml()
+        request_copy = copy.deepcopy(request)
+        request_copy.body_unicode = u'<b/>'
+        self.assertEqual(request_copy.request_body_xml().tag, 'b')
+        self.assertNotEqual(request_copy.id(), request_id)
+        self.assertEqual(request.request_body_xml().tag, 'a')
+        self.assertEqual(request.id(), request_id)
+
+    def test_deepcopy_shares_parsed(self):
+        import copy
+
+        request = self._make('<a>1</a>')
+        doc = request.request_body_xml()
+        request_copy = copy.deepcopy(request)
+        self.assertEqual(request_copy, request)
+        self.assertTrue(request_copy.request_body_xml() is doc)
+        request_copy.set_request_body_unicode(u'<b/>')
+        self.assertEqual(request_copy.request_body_xml().tag, 'b')
+        self.assertTrue(request.request_body_xml() is doc)
+
+    def test_copy_parses_own_query(self):
+        import copy
+
+        request = self._make('', **{'Stubo-Request-Query': 'q=2'})
+        request_id = request.id()
+        request_copy = copy.deepcopy(request)
+        request_copy.query = 'q=1'
+        self.assertEqual(request_copy.query_args(), {'q': ['1']})
+        self.assertNotEqual(request_copy.id(), request_id)
+        self.assertEqual(request.query_args(), {'q': ['2']})
+        self.assertEqual(request.id(), request_id)
+
+    def test_query_changed(self):
+        request = self._make('', **{'Stubo-Request-Query': 'q=2'})
+        self.assertEqual(request.query_args(), {'q': ['2']})
+        request.query = 'q=1'
+        self.assertEqual(request.query_args(), {'q': ['1']})
+
+    def test_id_of_raw_body(self):
+        from stubo.utils import compute_hash
+
+        def old_id(body, **headers):
+            return compute_hash(u''.join([self._make(body, **headers)
+                                          .request_body(), '', 'POST', '']))
+
+        for body, headers in [('<a>1</a>', {}),
+                              ('<a>\xc3\xa9</a>', {}),
+                              ('<a>\xe9</a>', {}),
+                              ('<a>1</a>', {'Content-Type': 'text/xml'}),
+                              ('<a>\xe9</a>', {'Content-Type': 'text/xml'}),
+                              ('<a>1</a>', {'Content-Type':
+                                            'text/xml; charset=utf-16'})]:
+            self.assertEqual(self._make(body, **headers).id(),
+                             old_id(body, **headers))
+
+    def test_ascii_body_not_decoded(self):
+        request = self._make('<a>1</a>', **{'Content-Type':
+                                            'text/xml; charset=utf-8'})
+        with mock.patch('stubo.model.request.decode_body') as decode_body:
+            request.id()
+        self.assertFalse(decode_body.called)
+        self.assertEqual(request.body_unicode, u'<a>1</a>')
+
+    def test_latin1_body_decoded(self):
+        request = self._make('<a>\xe9</a>', **{'Content-Type':
+                                               'text/xml; charset=latin-1'})
+        self.assertEqual(request.request_body(), u'<a>\xe9</a>')
@@ -40,7 +40,8 @@ from stubo.utils.track import TrackTrace
 from stubo.match import match
 from stubo.model.request import StuboRequest
 from stubo.ext import today_str
-from stubo.ext.transformer import transform
+from stubo.ext.transformer import transform, update_url_args
+from stubo.utils.stats import counters
 from stubo.ext.module import Module
 from .delay import Delay
 from stubo.model.export_commands import export_stubs_to_commands_format
@@ -342,7 +343,7 @@ def put_stub(handler, session_name, delay_policy, stateful, priority,
 
     session = cache.get_session(scenario_key.partition(':')[-1],
                                 session_name,
-                                local=False)
+                                local=False, stubs=False)
     if not session:
         raise exception_response(400, title='session not found - {0}'.format(
             session_name))
@@ -401,11 +402,18 @@ def get_response(handler, session_name):
     stubo_request = StuboRequest(request)
     cache = Cache(get_hostname(request))
 
-    scenario_key = cache.find_scenario_key(session_name)
-    scenario_name = scenario_key.partition(':')[-1]
-    handler.track.scenario = scenario_name
     # request_id - computed hash
     request_id = stubo_request.id()
+    # check cached requests
+    normalised_request_id = None
+    if handler.settings.get('normalised_request_cache'):
+        normalised_request_id = stubo_request.normalised_id()
+    # the scenario, then the cached request, response and delay in one round
+    # trip
+    scenario_name, cached_request, cached_response, cached_delay_policy = \
+        cache.lookup_response(session_name, request_id, normalised_request_id)
+    scenario_key = cache.scenario_key_name(scenario_name)
+    handler.track.scenario = scenario_name
     module_system_date = handler.get_argument('system_date', None)
     url_args = handler.track.request_params
     if not module_system_date:
@@ -413,8 +421,6 @@ def get_response(handler, session_name):
         module_system_date = handler.get_argument('stubbedSystemDate', None)
     trace_matcher = TrackTrace(handler.track, 'matcher')
     user_cache = handler.settings['ext_cache']
-    # check cached requests
-    cached_request = cache.get_request(scenario_name, session_name, request_id)
     if cached_request:
         response_ids, delay_policy_name, recorded, system_date, module_info, request_index_key = cached_request
     else:
@@ -452,11 +458,13 @@ def get_response(handler, session_name):
         module_info = stub.module()
         request_index_key = add_request(session, request_id, stub, system_date,
                                         stub_number,
-                                        handler.settings['request_cache_limit'])
+                                        handler.settings['request_cache_limit'],
+                                        normalised_request_id)
 
         if not stub.response_body():
             _response = stub.get_response_from_cache(request_index_key)
             stub.set_response_body(_response['body'])
+            stub.set_response_templated(_response.get('templated', True))
 
         if delay_policy_name:
             stub.load_delay_from_cache(delay_policy_name)
@@ -464,7 +472,8 @@ def get_response(handler, session_name):
     if cached_request:
         stub = StubCache({}, scenario_key, session_name)
         stub.load_from_cache(response_ids, delay_policy_name, recorded,
-                             system_date, module_info, request_index_key)
+                             system_date, module_info, request_index_key,
+                             cached_response, cached_delay_policy)
     trace_response = TrackTrace(handler.track, 'response')
     if module_info:
         trace_response.info('module used', str(module_info))
@@ -488,16 +497,23 @@ def get_response(handler, session_name):
     trace_response.info('found response')
     module_system_date = as_date(module_system_date) if module_system_date \
         else module_system_date
-    stub, _ = transform(stub,
-                        stubo_request,
-                        module_system_date=module_system_date,
-                        system_date=as_date(system_date),
-                        function='get/response',
-                        cache=user_cache,
-                        hooks=handler.settings['hooks'],
-                        stage='response',
-                        trace=trace_response,
-                        url_args=url_args)
+    hooks = handler.settings['hooks']
+    if not module_info and not stub.response_templated() and \
+            getattr(hooks, 'skip_static', False):
+        # no template markup so the transform would return it unchanged
+        counters.incr('get_response.static_response')
+        update_url_args(url_args, stub)
+    else:
+        stub, _ = transform(stub,
+                            stubo_request,
+                            module_system_date=module_system_date,
+                            system_date=as_date(system_date),
+                            function='get/response',
+                            cache=user_cache,
+                            hooks=hooks,
+                            stage='response',
+                            trace=trace_response,
+                            url_args=url_args)
     transfomed_response_text = stub.response_body()[0]
     # Note transformed_response_text can be encoded in utf8
     if response_text[0] != transfomed_response_text:
@@ -694,7 +710,8 @@ def end_session(handler, session_name):
 
     host, scenario_name = scenario_key.split(':')
 
-    session = cache.get_session(scenario_name, session_name, local=False)
+    session = cache.get_session(scenario_name, session_name, local=False,
+                                stubs=False)
     if not session:
         # end/session?session=x called before begin/session
         response['data'] = {
@@ -711,7 +728,8 @@ def end_session(handler, session_name):
     session['status'] = 'dormant'
     # clear stubs cache & scenario session data
     session.pop('stubs', None)
-    cache.set(scenario_key, session_name, session)
+    session.pop('version', None)
+    cache.set_session(scenario_name, session_name, session)
     cache.delete_session_data(scenario_name, session_name)
     if session_status == 'record':
         log.debug('store source recording to pre_scenario_stub')
@@ -856,6 +874,8 @@ def get_status(handler):
         'cluster': handler.settings.get('cluster_name'),
         'graphite_host': handler.settings.get('graphite.host')
     }
+    # process local fast path counters
+    response['data']['counters'] = counters.as_dict()
 
     try:
         result = redis_server.ping()
@@ -20,7 +20,8 @@ from stubo.utils.track import TrackTrace
 from stubo.match import match
 from stubo.utils import as_date
 from stubo.cache import add_request, StubCache
-from stubo.ext.transformer import transform
+from stubo.ext.transformer import transform, update_url_args
+from stubo.utils.stats import counters
 
 from stubo.cache import get_keys
 import sys
@@ -188,7 +189,8 @@ def end_session(hostname, session_name):
 
     host, scenario_name = scenario_key.split(':')
 
-    session = cache.get_session(scenario_name, session_name, local=False)
+    session = cache.get_session(scenario_name, session_name, local=False,
+                                stubs=False)
     if not session:
         # end/session?session=x called before begin/session
         response['data'] = {
@@ -205,7 +207,8 @@ def end_session(hostname, session_name):
     session['status'] = 'dormant'
     # clear stubs cache & scenario session data
     session.pop('stubs', None)
-    cache.set(scenario_key, session_name, session)
+    session.pop('version', None)
+    cache.set_session(scenario_name, session_name, session)
     cache.delete_session_data(scenario_name, session_name)
     if session_status == 'record':
         log.debug('store source recording to pre_scenario_stub')
@@ -516,7 +519,13 @@ def get_response_v2(handler, full_scenario_name, session_name):
     # trace_matcher = TrackTrace(handler.track, 'matcher')
     user_cache = handler.settings['ext_cache']
     # check cached requests
-    cached_request = cache.get_request(scenario_name, session_name, request_id)
+    normalised_request_id = None
+    if handler.settings.get('normalised_request_cache'):
+        normalised_request_id = stubo_request.normalised_id()
+    # the cached request, response and delay in one round trip
+    _, cached_request, cached_response, cached_delay_policy = \
+        cache.lookup_response(session_name, request_id, normalised_request_id,
+                              scenario_name=scenario_name)
     if cached_request:
         response_ids, delay_policy_name, recorded, system_date, module_info, request_index_key = cached_request
     else:
@@ -560,11 +569,13 @@ def get_response_v2(handler, full_scenario_name, session_name):
         module_info = stub.module()
         request_index_key = add_request(session, request_id, stub, system_date,
                                         stub_number,
-                                        handler.settings['request_cache_limit'])
+                                        handler.settings['request_cache_limit'],
+                                        normalised_request_id)
 
         if not stub.response_body():
             _response = stub.get_response_from_cache(request_index_key)
             stub.set_response_body(_response['body'])
+            stub.set_response_templated(_response.get('templated', True))
 
         if delay_policy_name:
             stub.load_delay_from_cache(delay_policy_name)
@@ -572,7 +583,8 @@ def get_response_v2(handler, full_scenario_name, session_name):
     if cached_request:
         stub = StubCache({}, full_scenario_name, session_name)
         stub.load_from_cache(response_ids, delay_policy_name, recorded,
-                             system_date, module_info, request_index_key)
+                             system_date, module_info, request_index_key,
+                             cached_response, cached_delay_policy)
     trace_response = TrackTrace(handler.track, 'response')
     if module_info:
         trace_response.info('module used', str(module_info))
@@ -598,16 +610,23 @@ def get_response_v2(handler, full_scenario_name, session_name):
     trace_response.info('found response')
     module_system_date = as_date(module_system_date) if module_system_date \
         else module_system_date
-    stub, _ = transform(stub,
-                        stubo_request,
-                        module_system_date=module_system_date,
-                        system_date=as_date(system_date),
-                        function='get/response',
-                        cache=user_cache,
-                        hooks=handler.settings['hooks'],
-                        stage='response',
-                        trace=trace_response,
-                        url_args=url_args)
+    hooks = handler.settings['hooks']
+    if not module_info and not stub.response_templated() and \
+            getattr(hooks, 'skip_static', False):
+        # no template markup so the transform would return it unchanged
+        counters.incr('get_response.static_response')
+        update_url_args(url_args, stub)
+    else:
+        stub, _ = transform(stub,
+                            stubo_request,
+                            module_system_date=module_system_date,
+                            system_date=as_date(system_date),
+                            function='get/response',
+                            cache=user_cache,
+                            hooks=hooks,
+                            stage='response',
+                            trace=trace_response,
+                            url_args=url_args)
     transfomed_response_text = stub.response_body()[0]
     # Note transformed_response_text can be encoded in utf8
     if response_text[0] != transfomed_response_text:
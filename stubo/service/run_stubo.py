@@ -16,9 +16,12 @@ from statsd import StatsClient
 
 from stubo.service.handlers import HandlerFactory
 from stubo.utils import (
-    read_config, init_mongo, start_redis, asbool, init_ext_cache, resolve_class
+    read_config, init_mongo, start_redis, asbool, init_ext_cache, resolve_class,
+    template_cache, set_hash_algorithm
 )
 from stubo.utils.command_queue import InternalCommandQueue
+from stubo.cache import local as local_cache
+from stubo.match.compiler import CompiledSession
 from stubo.utils.stats import StatsdStats
 from stubo import version, static_path, stubo_path
 from stubo.model.db import default_env, coerce_mongo_param
@@ -55,6 +58,21 @@ class TornadoManager(object):
         cfg['request_cache_limit'] = cfg.get('request_cache_limit', 10)
         cfg['decompress_request'] = cfg.get('decompress_request', True)
         cfg['compress_response'] = cfg.get('compress_response', False)
+        cfg['normalised_request_cache'] = asbool(
+            cfg.get('normalised_request_cache', False))
+        if cfg.get('hash_algorithm'):
+            digest_size = cfg.get('hash_digest_size')
+            set_hash_algorithm(cfg['hash_algorithm'],
+                               int(digest_size) if digest_size else None)
+        template_cache_size = cfg.get('template_cache_size')
+        if template_cache_size:
+            template_cache.resize(int(template_cache_size))
+        for name in ('unmatched_cache_size', 'unmatched_cache_ttl'):
+            if cfg.get(name) not in (None, ''):
+                setattr(CompiledSession, name, int(cfg[name]))
+        cfg['session_cache_size'] = int(cfg.get('session_cache_size', 1000))
+        if cfg['session_cache_size']:
+            local_cache.sessions.resize(cfg['session_cache_size'])
         self.cfg = cfg
 
     def get_cluster_name(self):
@@ -126,6 +144,9 @@ class TornadoManager(object):
             # see http://stackoverflow.com/questions/16153804/tornado-socket-error-on-arm    
             server.bind(tornado_port, '0.0.0.0')
         server.start(self.cfg['num_processes'])
+        if self.cfg['session_cache_size']:
+            # after forking, each process subscribes to invalidations
+            local_cache.subscribe(slave)
 
         max_process_workers = self.cfg.get('max_process_workers')
         if max_process_workers:
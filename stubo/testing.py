@@ -172,6 +172,7 @@ class DummyRequestHandler(object):
 class DummyHash(object):
     def __init__(self, keys=None):
         self._keys = keys or {}
+        self.published = []
 
     def __call__(self, *args):
         return self
@@ -188,17 +189,17 @@ class DummyHash(object):
             return False
         return name in item
 
-    def delete(self, name, keys):
+    def delete(self, name, *keys):
         item = self._keys.get(name)
         deleted = 0
         if item:
-            if isinstance(keys, basestring):
-                del item[keys]
-                deleted += 1
-            else:
-                for key in keys:
-                    del item[key]
-                    deleted += 1
+            for key in keys:
+                if isinstance(key, basestring):
+                    key = [key]
+                for k in key:
+                    if k in item:
+                        del item[k]
+                        deleted += 1
             self._keys[name] = item
         return deleted
 
@@ -252,6 +253,68 @@ class DummyHash(object):
         self.set(name, key, val)
         return val
 
+    def touch(self, name, key, score=None, hash_name=None, hash_key=None):
+        import time
+
+        if hash_name is not None and not self.exists(hash_name, hash_key):
+            return
+        if name not in self._keys:
+            self._keys[name] = {}
+        self._keys[name][key] = score or time.time()
+
+    def set_lru(self, name, lru_name, keys, value, size, prefix='',
+                index_name=None, index_value=''):
+        import time
+
+        if index_name:
+            self.set_raw(index_name, lru_name, index_value)
+        now = time.time()
+        for key in keys:
+            self.set(name, prefix + key, value)
+            self.touch(lru_name, key, now)
+        item = self._keys[lru_name]
+        ranked = sorted(item, key=lambda x: (item[x], x))
+        removed = ranked[:max(0, len(ranked) - size)]
+        for key in removed:
+            del item[key]
+            del self._keys[name][prefix + key]
+        return removed
+
+    def get_cached_response(self, host, scenario_name, session_name,
+                            request_ids):
+        scenario_name = scenario_name or self.get_raw(
+            '{0}:sessions'.format(host), session_name)
+        if not scenario_name:
+            return [None] * 5
+        scenario_key = '{0}:{1}'.format(host, scenario_name)
+        for request_id in request_ids:
+            cached_request = self.get('{0}:request'.format(scenario_key),
+                                      '{0}:{1}'.format(session_name,
+                                                       request_id))
+            if cached_request:
+                response_ids, delay_policy_name = cached_request[:2]
+                response = delay_policy = None
+                if len(response_ids) == 1:
+                    response = self.get('{0}:response'.format(scenario_key),
+                                        '{0}:{1}'.format(session_name,
+                                                         response_ids[0]))
+                if delay_policy_name:
+                    delay_policy = self.get('{0}:delay_policy'.format(host),
+                                            delay_policy_name)
+                return [scenario_name, request_id, cached_request, response,
+                        delay_policy]
+        return [scenario_name, None, None, None, None]
+
+    def next_response(self, index_name, index_key, name, keys):
+        index = self.get(index_name, index_key) or 0
+        if index < len(keys):
+            index = self.incr(index_name, index_key)
+        return self.get(name, keys[min(index, len(keys)) - 1])
+
+    def publish(self, channel, msg):
+        self.published.append((channel, msg))
+        return 0
+
 
 from stubo.cache import Cache
 from stubo.model.db import Scenario
@@ -21,6 +21,7 @@ from asyncore import compact_traceback
 from StringIO import StringIO
 from importlib import import_module
 import hashlib
+import ast
 
 from pytz import timezone
 import redis
@@ -36,6 +37,7 @@ from dogpile.cache import make_region
 # from stubo.cache.backends
 
 from stubo.scripts import get_default_config
+from stubo.utils.lru import LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -58,9 +60,27 @@ def asbool(s):
     return s.lower() in truthy
 
 
+def literal_dict(text):
+    """ Safely parse a dict literal (python or JSON style without booleans or
+    null) or a sequence of key, value pairs, a blank string is empty."""
+    if not text.strip():
+        return {}
+    return dict(ast.literal_eval(text.strip()))
+
+
+def has_template_markup(text):
+    """ Return True if text contains tornado template markup, text without it
+    is returned unchanged by :func:`run_template`."""
+    return '{{' in text or '{%' in text or '{#' in text
+
+
+#: compiled templates by source, shared by all run_template callers
+template_cache = LRUCache(500, 'template_cache')
+
+
 def run_template(templ, **kwargs):
     log.debug(u"run_template-> {0}".format(kwargs))
-    t = Template(templ)
+    t = template_cache.get_or_create(templ, lambda: Template(templ))
     return t.generate(**kwargs)
 
 
@@ -86,16 +106,52 @@ def read_config(config_file_path=None, section=None):
     return dict(config.items(section))
 
 
-def setup_redis(host='localhost', port=6379, db=0, password=None):
+def setup_redis(host='localhost', port=6379, db=0, password=None,
+                max_connections=50, pool_timeout=20, socket_timeout=None,
+                socket_connect_timeout=None):
     """
-    Returns Redis connection pool
+    Returns Redis client on its own blocking connection pool
     :param host: Redis hostname
     :param port: Redis port
     :param db: Database ID (optional)
     :param password: Redis password
-    :return: Redis connection pool
+    :param max_connections: connections in the pool, callers wait for a
+                            connection once they are all in use
+    :param pool_timeout: seconds to wait for a free connection
+    :param socket_timeout: seconds to wait for a reply, None for no timeout
+    :param socket_connect_timeout: seconds to wait to connect
+    :return: Redis client
     """
-    return redis.Redis(host, port, db, password)
+    pool = redis.BlockingConnectionPool(
+        max_connections=max_connections, timeout=pool_timeout, host=host,
+        port=port, db=db, password=password, socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_connect_timeout)
+    return redis.Redis(connection_pool=pool)
+
+
+def redis_settings(settings, prefix):
+    """
+    Returns the setup_redis arguments of the redis or redis_master settings,
+    REDIS_ADDRESS, REDIS_PORT and REDIS_PASSWORD override them if set.
+    """
+
+    def number(name, convert, default=None):
+        value = settings.get('{0}.{1}'.format(prefix, name))
+        return default if value in (None, '') else convert(value)
+
+    args = dict(host=settings.get('{0}.host'.format(prefix), '127.0.0.1'),
+                port=number('port', int, 6379),
+                db=number('db', int, 0),
+                password=settings.get('{0}.password'.format(prefix)),
+                max_connections=number('max_connections', int, 50),
+                pool_timeout=number('pool_timeout', float, 20),
+                socket_timeout=number('socket_timeout', float),
+                socket_connect_timeout=number('socket_connect_timeout', float))
+    if os.getenv('REDIS_ADDRESS') and os.getenv('REDIS_PORT'):
+        args.update(host=os.getenv('REDIS_ADDRESS'),
+                    port=int(os.getenv('REDIS_PORT')),
+                    password=os.getenv('REDIS_PASSWORD') or args['password'])
+    return args
 
 
 def init_redis(settings):
@@ -104,13 +160,10 @@ def init_redis(settings):
     :param settings: Tornado app settings
     :return: Redis connection pool (usually slave)
     """
-    host = settings.get('redis.host', '127.0.0.1')
-    port = int(settings.get('redis.port', 6379))
-    db = int(settings.get('redis.db', 0))
-    passwd = settings.get('redis.password')
     import stubo.cache.queue
 
-    stubo.cache.queue.redis_server = setup_redis(host, port, db, passwd)
+    stubo.cache.queue.redis_server = setup_redis(**redis_settings(settings,
+                                                                  'redis'))
     return stubo.cache.queue.redis_server
 
 
@@ -120,13 +173,10 @@ def init_redis_master(settings):
     :param settings: Tornado app settings
     :return: Redis connection pool (master)
     """
-    host = settings.get('redis_master.host', '127.0.0.1')
-    port = int(settings.get('redis_master.port', 6379))
-    db = int(settings.get('redis_master.db', 0))
-    passwd = settings.get('redis_master.password')
     import stubo.cache.backends
 
-    stubo.cache.backends.redis_master_server = setup_redis(host, port, db, passwd)
+    stubo.cache.backends.redis_master_server = setup_redis(
+        **redis_settings(settings, 'redis_master'))
     return stubo.cache.backends.redis_master_server
 
 
@@ -136,13 +186,10 @@ def start_redis(cfg):
     :param cfg: Tornado app settings
     :return:
     """
-    redis_local = (cfg.get('redis.host', '127.0.0.1'),
-                   int(cfg.get('redis.port', 6379)),
-                   int(cfg.get('redis.db', 0)))
-
-    redis_master = (cfg.get('redis_master.host', '127.0.0.1'),
-                    int(cfg.get('redis_master.port', 6379)),
-                    int(cfg.get('redis_master.db', 0)))
+    redis_local = [redis_settings(cfg, 'redis')[x] for x in
+                   ('host', 'port', 'db')]
+    redis_master = [redis_settings(cfg, 'redis_master')[x] for x in
+                    ('host', 'port', 'db')]
     retry_count = int(cfg.get('retry_count', 10))
     retry_interval = int(cfg.get('retry_interval', 10))
     redis_local_server = init_redis(cfg)
@@ -304,24 +351,32 @@ def get_unicode_from_request(r):
     if isinstance(r.body, unicode):
         return r.body
 
-    tried_encodings = []
-
     # Try charset from content-type
     # i.e. "Content-type: text/plain; charset=us-ascii"
     encoding = get_encoding_from_headers(CaseInsensitiveDict(r.headers))
+    return decode_body(r.body, encoding)
+
+
+def decode_body(body, encoding=None):
+    """Returns a request body in unicode using the charset encoding if any,
+    see :func:`get_unicode_from_request`."""
+    if isinstance(body, unicode):
+        return body
+
+    tried_encodings = []
 
     if encoding:
         try:
-            return unicode(r.body, encoding)
-        except UnicodeError:
+            return unicode(body, encoding)
+        except (UnicodeError, LookupError):
             tried_encodings.append(encoding)
 
     # workaround if encoding is not specified, assume utf-8, then latin-1                 
     try:
-        return unicode(r.body, 'utf-8')
+        return unicode(body, 'utf-8')
     except:
         tried_encodings.append('utf-8')
-        return unicode(r.body, 'latin-1', errors='replace')
+        return unicode(body, 'latin-1', errors='replace')
 
 
 def compact_traceback_info(tb):
@@ -341,9 +396,50 @@ def compact_traceback_info(tb):
     return ' '.join(['[%s|%s|%s]' % x for x in tbinfo])
 
 
+# the hash used for request, response and request index ids and the
+# namespace its ids are prefixed with, empty for the original sha224
+_hash_factory = hashlib.sha224
+_hash_namespace = ''
+_hash_length = None
+
+
+def set_hash_algorithm(name='sha224', digest_size=None):
+    """ Select the hash used by :func:`compute_hash`.
+
+    :Params:
+      - `name`: a hashlib algorithm, or blake2b if pyblake2 is installed
+      - `digest_size` (optional): digest size in bytes, longer digests are
+        truncated
+
+    Ids of any other than the default sha224 are prefixed with the algorithm
+    and digest size, so the cached ids of servers configured differently
+    never collide while a new algorithm is rolled out.
+    """
+    global _hash_factory, _hash_namespace, _hash_length
+    if name == 'blake2b':
+        try:
+            from pyblake2 import blake2b
+        except ImportError:
+            raise ValueError('hash algorithm blake2b needs pyblake2 installed')
+        factory = lambda data: blake2b(data, digest_size=digest_size or 64)
+        length = None
+    elif name in hashlib.algorithms:
+        factory = getattr(hashlib, name)
+        length = digest_size * 2 if digest_size else None
+    else:
+        raise ValueError('unknown hash algorithm: {0}'.format(name))
+    _hash_factory = factory
+    _hash_length = length
+    if name == 'sha224' and not digest_size:
+        _hash_namespace = ''
+    else:
+        _hash_namespace = '{0}{1}.'.format(name, digest_size or '')
+
+
 def compute_hash(data):
     if isinstance(data, unicode):
-        _hash = hashlib.sha224(data.encode('utf-8')).hexdigest()
-    else:
-        _hash = hashlib.sha224(data).hexdigest()
-    return _hash
+        data = data.encode('utf-8')
+    _hash = _hash_factory(data).hexdigest()
+    if _hash_length:
+        _hash = _hash[:_hash_length]
+    return _hash_namespace + _hash
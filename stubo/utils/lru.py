@@ -0,0 +1,102 @@
+"""
+    stubo.utils.lru
+    ~~~~~~~~~~~~~~~
+
+    Bounded least recently used caches local to a process.
+
+    :copyright: (c) 2015 by OpenCredo.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from stubo.utils.stats import counters
+
+
+class LRUCache(object):
+    """ Thread safe mapping holding at most ``maxsize`` items, the least
+    recently used item is evicted to make room for a new one. If ``ttl`` is
+    given items also expire that many seconds after they were set.
+
+    Hits, misses and evictions are counted in
+    :data:`~stubo.utils.stats.counters` as ``<name>.hit``, ``<name>.miss``
+    and ``<name>.eviction``.
+    """
+
+    def __init__(self, maxsize, name, ttl=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires = self._items.pop(key, (_missing, None))
+            if expires is not None and expires <= time.time():
+                value = _missing
+            if value is not _missing:
+                # most recently used items are kept at the end
+                self._items[key] = value, expires
+        if value is _missing:
+            counters.incr(self.name + '.miss')
+            return default
+        counters.incr(self.name + '.hit')
+        return value
+
+    def set(self, key, value):
+        evicted = 0
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value, expires
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                evicted += 1
+        if evicted:
+            counters.incr(self.name + '.eviction', evicted)
+
+    def get_or_create(self, key, creator):
+        """ Return the item for key, calling creator() to make it on a miss.
+        creator runs outside the lock so concurrent misses may both call it.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = creator()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value, _ = self._items.pop(key, (default, None))
+            return value
+
+    def discard(self, predicate):
+        """ Remove the items whose key satisfies predicate, returns how many
+        were removed.
+        """
+        with self._lock:
+            keys = [k for k in self._items if predicate(k)]
+            for key in keys:
+                del self._items[key]
+        return len(keys)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._items) > maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+_missing = object()
@@ -3,9 +3,39 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import logging
+import threading
+from collections import defaultdict
 
 log = logging.getLogger(__name__)
 
+
+class Counters(object):
+    """ Thread safe counters local to this process, reported by get/status.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def get(self, name):
+        return self._counts.get(name, 0)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+counters = Counters()
+
+
 class Stats(object):
         
     def send(self, settings, track):
@@ -0,0 +1,86 @@
+import unittest
+import mock
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        from stubo.utils.stats import counters
+        counters.reset()
+
+    def _get_cls(self, maxsize=2):
+        from stubo.utils.lru import LRUCache
+        return LRUCache(maxsize, 'test_lru')
+
+    def _count(self, name):
+        from stubo.utils.stats import counters
+        return counters.get('test_lru.' + name)
+
+    def test_get(self):
+        cache = self._get_cls()
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(self._count('hit'), 1)
+        self.assertEqual(self._count('miss'), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self._get_cls()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(self._count('eviction'), 1)
+
+    def test_get_or_create(self):
+        cache = self._get_cls()
+        made = []
+
+        def creator():
+            made.append(1)
+            return len(made)
+
+        self.assertEqual(cache.get_or_create('a', creator), 1)
+        self.assertEqual(cache.get_or_create('a', creator), 1)
+        self.assertEqual(len(made), 1)
+
+    def test_ttl(self):
+        from stubo.utils.lru import LRUCache
+        cache = LRUCache(2, 'test_lru', ttl=10)
+        with mock.patch('stubo.utils.lru.time.time', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('stubo.utils.lru.time.time', return_value=109):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('stubo.utils.lru.time.time', return_value=110):
+            self.assertEqual(cache.get('a'), None)
+        self.assertFalse('a' in cache)
+
+    def test_discard(self):
+        cache = self._get_cls(3)
+        for key in ('a1', 'a2', 'b1'):
+            cache.set(key, key)
+        self.assertEqual(cache.discard(lambda k: k.startswith('a')), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue('b1' in cache)
+
+    def test_resize(self):
+        cache = self._get_cls(3)
+        for key in 'abc':
+            cache.set(key, key)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue('c' in cache)
+
+
+class TestRunTemplate(unittest.TestCase):
+
+    def test_compiled_once(self):
+        from stubo.utils import run_template, template_cache
+        template_cache.clear()
+        self.assertEqual(run_template('{{1+x}}', x=1), '2')
+        compiled = template_cache.get('{{1+x}}')
+        self.assertEqual(run_template('{{1+x}}', x=2), '3')
+        self.assertTrue(template_cache.get('{{1+x}}') is compiled)
@@ -1,5 +1,26 @@
 import unittest
                 
+class TestCounters(unittest.TestCase):
+
+    def _get_cls(self):
+        from stubo.utils.stats import Counters
+        return Counters()
+
+    def test_incr(self):
+        counters = self._get_cls()
+        counters.incr('a')
+        counters.incr('a', 2)
+        self.assertEqual(counters.get('a'), 3)
+        self.assertEqual(counters.get('b'), 0)
+        self.assertEqual(counters.as_dict(), {'a': 3})
+
+    def test_reset(self):
+        counters = self._get_cls()
+        counters.incr('a')
+        counters.reset()
+        self.assertEqual(counters.as_dict(), {})
+
+
 class TestStats(unittest.TestCase):
     
     def _get_cls(self):
@@ -0,0 +1,75 @@
+import unittest
+import hashlib
+import mock
+
+
+class TestComputeHash(unittest.TestCase):
+
+    def tearDown(self):
+        from stubo.utils import set_hash_algorithm
+        set_hash_algorithm()
+
+    def test_default(self):
+        from stubo.utils import compute_hash
+        self.assertEqual(compute_hash(u'abc'),
+                         hashlib.sha224('abc').hexdigest())
+
+    def test_algorithm_namespaced(self):
+        from stubo.utils import compute_hash, set_hash_algorithm
+        set_hash_algorithm('sha1', 8)
+        self.assertEqual(compute_hash(u'abc'),
+                         'sha18.' + hashlib.sha1('abc').hexdigest()[:16])
+        set_hash_algorithm('md5')
+        self.assertEqual(compute_hash('abc'),
+                         'md5.' + hashlib.md5('abc').hexdigest())
+
+    def test_unknown_algorithm(self):
+        from stubo.utils import set_hash_algorithm
+        with self.assertRaises(ValueError):
+            set_hash_algorithm('crc')
+
+
+class TestRedisSettings(unittest.TestCase):
+
+    def test_pool(self):
+        from stubo.utils import setup_redis
+        server = setup_redis(port=6380, max_connections=5, socket_timeout=2)
+        pool = server.connection_pool
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 2)
+
+    def test_settings(self):
+        from stubo.utils import redis_settings
+        with mock.patch.dict('os.environ', {}, clear=True):
+            args = redis_settings({'redis.host': 'slave', 'redis.port': '1',
+                                   'redis.socket_timeout': '0.5'}, 'redis')
+        self.assertEqual(args['host'], 'slave')
+        self.assertEqual(args['port'], 1)
+        self.assertEqual(args['socket_timeout'], 0.5)
+        self.assertEqual(args['max_connections'], 50)
+
+    def test_settings_from_environment(self):
+        from stubo.utils import redis_settings
+        with mock.patch.dict('os.environ', {'REDIS_ADDRESS': 'redis',
+                                            'REDIS_PORT': '6390'}):
+            args = redis_settings({'redis_master.host': 'master'},
+                                  'redis_master')
+        self.assertEqual((args['host'], args['port']), ('redis', 6390))
+
+    def test_servers_shared(self):
+        from stubo.utils import start_redis
+        from stubo.cache.backends import RedisCacheBackend, get_redis_master
+        import stubo.cache.queue
+        import stubo.cache.backends
+        saved = stubo.cache.queue.redis_server, \
+            stubo.cache.backends.redis_master_server
+        try:
+            slave, master = start_redis({})
+            self.assertTrue(master is slave)
+            self.assertTrue(RedisCacheBackend().server is slave)
+            self.assertTrue(RedisCacheBackend(get_redis_master()).server
+                            is master)
+        finally:
+            stubo.cache.queue.redis_server, \
+                stubo.cache.backends.redis_master_server = saved